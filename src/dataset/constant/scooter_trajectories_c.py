@@ -14,6 +14,11 @@ class ScooterTrajectoriesC:
     CSV_MERGE_GENERATED_FN: Final = "merge_gen.csv"
     CSV_DATASET_GENERATED_FN: Final = "dataset_gen.csv"
     CSV_MOVING_BEHAVIOR_FEATURE: Final = "moving_behavior_feature.csv"
+    CSV_CLUSTERING_EVALUATION_FN: Final = "clustering_evaluation.csv"
+    JSON_MOVING_BEHAVIOR_FEATURE_CHECKPOINT: Final = "moving_behavior_feature_checkpoint.json"
+    MOVING_BEHAVIOR_WINDOW_STORE_DN: Final = "moving_behavior_window_store"
+    AUTOENCODER_EXPORT_DN: Final = "autoencoder_export"
+    CLUSTERING_PREPROCESSING_CACHE_DN: Final = "clustering_preprocessing_cache"
 
     POS_RENTAL_CN: Final = "rental"
 
@@ -209,6 +214,7 @@ class ScooterTrajectoriesC:
 
     # moving behavior feature extraction
     SLIDING_WINDOW_WIDTH = 12
+    SLIDING_WINDOW_DURATION = "60s"
     MOVING_ATTRIBUTES = [POS_GEN_SERVER_TIME_CN, POS_GEN_DEVICE_TIME_CN, POS_GEN_LATITUDE_CN, POS_GEN_LONGITUDE_CN,
                          POS_GEN_SPEED_CN]
     MOVING_BEHAVIOR_FEATURES_COLS = ["f_delta_latitude_mean", "f_delta_latitude_max", "f_delta_latitude_quantile75",
@@ -0,0 +1,493 @@
+"""Moving Behavior
+
+Vectorized moving behavior feature extraction over the position trajectories of Scooter Trajectories dataset.
+The per-position deltas are calculated once over the sorted position arrays, all the sliding windows of all the
+trajectories are built with a strided view and the window statistics are taken with batched NumPy calls.
+The trajectories can be split in shards processed by worker processes that read the positions from a memory map.
+The window features are statistics of window signals taken from registries, so that only the requested ones are
+calculated and new signals, statistics and features are added without changing the engines.
+
+Functions
+---------
+trajectory_offsets(pos, groupby)
+    sort the positions by trajectory and return the trajectory keys and offsets
+window_bounds(lengths, sw_width, sw_offset)
+    build the sliding windows of each trajectory
+time_window_bounds(times, offsets, sw_width, sw_offset)
+    build the time sliding windows of each trajectory
+shard_bounds(offsets, n_shards)
+    split the trajectories in shards balanced by number of positions
+register_window_signal(name, signal)
+    register a window signal computed from the position deltas
+register_window_statistic(name, statistic, ordered)
+    register a window statistic
+register_window_feature(column, signal, statistic)
+    register a window feature column as a statistic of a signal
+window_statistics(windows, statistics, ordered)
+    calculate the statistics of each window
+moving_behavior_features(pos, groupby, sw_width, sw_offset, n_jobs, time_window, features)
+    calculate the moving behavior features of each sliding window of each trajectory
+"""
+import os
+import itertools
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:  # NumPy < 1.20
+    from numpy.lib.stride_tricks import as_strided
+
+    def sliding_window_view(x, window_shape):
+        return as_strided(x, shape=(x.shape[0] - window_shape + 1, window_shape), strides=x.strides * 2,
+                          writeable=False)
+
+from .constant import ScooterTrajectoriesC as C
+
+QUANTILES = [0.75, 0.50, 0.25]
+# Memory mapped position arrays shared with the workers
+TIMES_FN = "times.npy"
+VALUES_FN = "values.npy"
+# More shards than workers to balance the load of long trajectories
+SHARDS_PER_JOB = 4
+
+
+def trajectory_offsets(pos: pd.DataFrame, groupby):
+    """
+    Sort the positions by trajectory, keeping the original order inside each trajectory.
+
+    Parameters
+    ----------
+    pos : DataFrame
+        positions with at least the groupby columns
+    groupby : str or list
+        columns that identify a trajectory
+
+    Returns
+    -------
+    (ndarray, DataFrame, ndarray)
+        positions order, trajectory keys sorted as pandas groupby and trajectory start offsets (size keys + 1)
+    """
+    group_ids = pos.groupby(by=groupby, sort=True).ngroup().to_numpy()
+    valid = np.flatnonzero(group_ids >= 0)
+    order = valid[np.argsort(group_ids[valid], kind="stable")]
+    sorted_ids = group_ids[order]
+
+    first = np.flatnonzero(np.r_[True, sorted_ids[1:] != sorted_ids[:-1]]) if len(order) else np.empty(0, np.int64)
+    groupby_cols = groupby if type(groupby) == list else [groupby]
+    keys = pos[groupby_cols].iloc[order[first]].reset_index(drop=True)
+    offsets = np.r_[first, len(order)].astype(np.int64)
+    return order, keys, offsets
+
+
+def window_bounds(lengths, sw_width, sw_offset):
+    """
+    Build the sliding windows of each trajectory: a window starts every sw_offset positions and the last window is
+    the first one that reaches the end of the trajectory. Windows with less than two positions are discarded.
+
+    Parameters
+    ----------
+    lengths : ndarray
+        number of positions of each trajectory
+    sw_width : int
+        sliding window width in positions
+    sw_offset : int
+        sliding window offset in positions
+
+    Returns
+    -------
+    (ndarray, ndarray, ndarray, ndarray)
+        trajectory index, window start inside the trajectory, window length and window id inside the trajectory
+    """
+    sw_width, sw_offset = int(sw_width), max(int(sw_offset), 1)
+    lengths = np.asarray(lengths, dtype=np.int64)
+
+    # Number of windows: the first window that reaches the trajectory end is the last one
+    counts = np.where(lengths > sw_width, -(-(lengths - sw_width) // sw_offset) + 1, 1)
+    counts = np.where(lengths > 0, counts, 0)
+
+    traj_idx = np.repeat(np.arange(len(lengths)), counts)
+    starts = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) * sw_offset
+    win_len = np.minimum(sw_width, lengths[traj_idx] - starts)
+
+    # Discard the windows that starts out of the trajectory or with one position
+    valid = win_len > 1
+    traj_idx, starts, win_len = traj_idx[valid], starts[valid], win_len[valid]
+
+    # Window id counts only the valid windows of each trajectory
+    new_traj = np.r_[True, traj_idx[1:] != traj_idx[:-1]] if len(traj_idx) else np.empty(0, bool)
+    first = np.flatnonzero(new_traj)
+    window_id = np.arange(len(traj_idx)) - np.repeat(first, np.diff(np.r_[first, len(traj_idx)]))
+    return traj_idx, starts, win_len, window_id
+
+
+def _search_sorted(times, lo, hi, targets):
+    # Binary search of each target inside its own sorted slice times[lo:hi]: first index with time >= target
+    while np.any(lo < hi):
+        active = lo < hi
+        mid = (lo + hi) // 2
+        lower = active & (times[np.minimum(mid, len(times) - 1)] < targets)
+        lo = np.where(lower, mid + 1, lo)
+        hi = np.where(active & ~lower, mid, hi)
+    return lo
+
+
+def time_window_bounds(times, offsets, sw_width, sw_offset):
+    """
+    Build the time sliding windows of each trajectory: a window starts every sw_offset nanoseconds from the first
+    position and contains the positions in [start, start + sw_width), the last window is the first one that reaches
+    the last position. The window bounds are found by binary search, windows with less than two positions are
+    discarded.
+
+    Parameters
+    ----------
+    times : ndarray
+        positions time in nanoseconds, sorted inside each trajectory
+    offsets : ndarray
+        trajectory start offsets (size trajectories + 1), each trajectory has at least one position
+    sw_width : int
+        sliding window width in nanoseconds
+    sw_offset : int
+        sliding window offset in nanoseconds
+
+    Returns
+    -------
+    (ndarray, ndarray, ndarray, ndarray)
+        trajectory index, window start inside the trajectory, window length and window id inside the trajectory
+    """
+    sw_width, sw_offset = int(sw_width), max(int(sw_offset), 1)
+    first = offsets[:-1]
+    duration = times[offsets[1:] - 1] - times[first]
+
+    # Number of windows: the first window that reaches the last position is the last one
+    counts = np.where(duration >= sw_width, (duration - sw_width) // sw_offset + 2, 1)
+
+    traj_idx = np.repeat(np.arange(len(first)), counts)
+    window_start = times[first[traj_idx]] + \
+        (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) * sw_offset
+    lo, hi = first[traj_idx], offsets[1:][traj_idx]
+    win_first = _search_sorted(times, lo, hi, window_start)
+    win_end = _search_sorted(times, lo, hi, window_start + sw_width)
+    starts, win_len = win_first - lo, win_end - win_first
+
+    # Discard the windows with one position or without positions
+    valid = win_len > 1
+    traj_idx, starts, win_len = traj_idx[valid], starts[valid], win_len[valid]
+
+    new_traj = np.r_[True, traj_idx[1:] != traj_idx[:-1]] if len(traj_idx) else np.empty(0, bool)
+    first_window = np.flatnonzero(new_traj)
+    window_id = np.arange(len(traj_idx)) - np.repeat(first_window, np.diff(np.r_[first_window, len(traj_idx)]))
+    return traj_idx, starts, win_len, window_id
+
+
+def shard_bounds(offsets, n_shards):
+    """
+    Split the trajectories in shards with about the same number of positions, without splitting a trajectory.
+
+    Parameters
+    ----------
+    offsets : ndarray
+        trajectory start offsets (size trajectories + 1)
+    n_shards : int
+        number of shards wanted
+
+    Returns
+    -------
+    ndarray
+        trajectory index bounds of each shard (size shards + 1)
+    """
+    targets = np.linspace(0, offsets[-1], max(int(n_shards), 1) + 1)
+    bounds = np.searchsorted(offsets, targets, side="left")
+    bounds[0], bounds[-1] = 0, len(offsets) - 1
+    return np.unique(bounds)
+
+
+def _moving_arrays(pos: pd.DataFrame):
+    # Time columns as nanoseconds and the other moving attributes as float
+    times = np.vstack([pos[cn].astype("datetime64[ns]").to_numpy().view(np.int64)
+                       for cn in [C.POS_GEN_SERVER_TIME_CN, C.POS_GEN_DEVICE_TIME_CN]])
+    values = np.vstack([pos[cn].to_numpy(dtype=np.float64)
+                        for cn in [C.POS_GEN_LATITUDE_CN, C.POS_GEN_LONGITUDE_CN, C.POS_GEN_SPEED_CN]])
+    return times, values
+
+
+def _moving_deltas(times, values):
+    # Mean of server and device time deltas, truncated to nanoseconds
+    delta_t = (np.diff(times, axis=1).sum(axis=0) / 2).astype(np.int64)
+    delta_latitude, delta_longitude, delta_s = np.diff(values, axis=1)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        f_delta_latitude = delta_latitude / delta_t
+        f_delta_longitude = delta_longitude / delta_t
+        rot = np.arctan(delta_longitude / delta_latitude)
+    rot[np.isnan(rot)] = 0
+
+    return {"f_delta_latitude": f_delta_latitude, "f_delta_longitude": f_delta_longitude, "f_delta_s": delta_s,
+            "rot": rot}
+
+
+def _windows(values, starts, mask):
+    # values padded so that each window start has a full width view
+    width = mask.shape[1]
+    padded = np.r_[values, np.full(width, np.nan)]
+    windows = sliding_window_view(padded, width)[starts]
+    return np.where(mask, windows, np.nan)
+
+
+def _lerp(a, b, t):
+    # Same linear interpolation of numpy quantile
+    diff_b_a = b - a
+    return np.where(t >= 0.5, b - diff_b_a * (1 - t), a + diff_b_a * t)
+
+
+def _mean(windows, ordered, count):
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(np.isnan(windows), 0, windows).sum(axis=1) / count
+
+
+def _max(windows, ordered, count):
+    return np.fmax.reduce(windows, axis=1)
+
+
+def _min(windows, ordered, count):
+    return np.fmin.reduce(windows, axis=1)
+
+
+def _quantile(q):
+    def quantile(windows, ordered, count):
+        # NaN are sorted at the end: the first count values of each row are valid
+        rows = np.arange(len(ordered))
+        last = np.maximum(count - 1, 0)
+        virtual = q * last
+        previous = np.floor(virtual).astype(np.int64)
+        following = np.minimum(previous + 1, last)
+        with np.errstate(invalid="ignore"):
+            return _lerp(ordered[rows, previous], ordered[rows, following], virtual - previous)
+    return quantile
+
+
+def _position_signal(delta_name):
+    def signal(deltas, starts, mask):
+        return _windows(deltas[delta_name], starts, mask)
+    return signal
+
+
+def _rot_delta_signal(deltas, starts, mask):
+    # ROT delta: the first delta of each window is the ROT itself
+    return np.diff(_windows(deltas["rot"], starts, mask), axis=1, prepend=0)
+
+
+# Window signals: name -> function(deltas, starts, mask) that returns the windows matrix padded with NaN
+WINDOW_SIGNALS = {
+    "f_delta_latitude": _position_signal("f_delta_latitude"),
+    "f_delta_longitude": _position_signal("f_delta_longitude"),
+    "f_delta_s": _position_signal("f_delta_s"),
+    "f_delta_r": _rot_delta_signal,
+}
+# Window statistics: name -> (function(windows, ordered, count), True if it needs the sorted windows)
+WINDOW_STATISTICS = {
+    "mean": (_mean, False),
+    "max": (_max, False),
+    **{"quantile{}".format(int(q * 100)): (_quantile(q), True) for q in QUANTILES},
+    "min": (_min, False),
+}
+DEFAULT_STATISTICS = list(WINDOW_STATISTICS)
+# Window features: column name -> (signal, statistic), the default columns are all the statistics of all the signals
+WINDOW_FEATURES = dict(zip(C.MOVING_BEHAVIOR_FEATURES_COLS, itertools.product(WINDOW_SIGNALS, DEFAULT_STATISTICS)))
+
+
+def register_window_signal(name, signal):
+    """
+    Register a window signal, the function is called with the per-position deltas dictionary (f_delta_latitude,
+    f_delta_longitude, f_delta_s, rot), the first delta of each window and the windows mask, and returns the windows
+    matrix padded with NaN. Register the signals at import time, so that the worker processes see them.
+
+    Parameters
+    ----------
+    name : str
+        signal name
+    signal : function
+        function(deltas, starts, mask) -> ndarray
+    """
+    WINDOW_SIGNALS[name] = signal
+
+
+def register_window_statistic(name, statistic, ordered=False):
+    """
+    Register a window statistic, the function is called with the windows matrix padded with NaN, the windows sorted
+    along the rows with NaN at the end (None if not ordered) and the number of values of each window.
+
+    Parameters
+    ----------
+    name : str
+        statistic name
+    statistic : function
+        function(windows, ordered, count) -> ndarray
+    ordered : bool
+        True if the statistic needs the sorted windows, the sort is shared by all the statistics of a signal
+    """
+    WINDOW_STATISTICS[name] = (statistic, ordered)
+
+
+def register_window_feature(column, signal, statistic):
+    """
+    Register a window feature column as a statistic of a signal.
+
+    Parameters
+    ----------
+    column : str
+        feature column name
+    signal : str
+        registered signal name
+    statistic : str
+        registered statistic name
+    """
+    WINDOW_FEATURES[column] = (signal, statistic)
+
+
+def _feature_plan(features):
+    # Statistics of each signal needed by the features, in order of request
+    plan = {}
+    for column in features:
+        signal, statistic = WINDOW_FEATURES[column]
+        statistics = plan.setdefault(signal, [])
+        if statistic not in statistics:
+            statistics.append(statistic)
+    return plan
+
+
+def window_statistics(windows, statistics=None, ordered=None):
+    """
+    Statistics of each window, ignoring NaN values as pandas Series does. The windows are sorted only once and only
+    if a statistic needs them sorted.
+
+    Parameters
+    ----------
+    windows : ndarray
+        windows matrix (windows, width) padded with NaN
+    statistics : list, optional
+        registered statistic names, default mean, max, quantile 75, quantile 50, quantile 25, min
+    ordered : ndarray, optional
+        windows matrix already sorted along the rows, with NaN at the end
+
+    Returns
+    -------
+    ndarray
+        (windows, statistics) matrix
+    """
+    statistics = DEFAULT_STATISTICS if statistics is None else statistics
+    count = (~np.isnan(windows)).sum(axis=1)
+    if ordered is None and any(WINDOW_STATISTICS[name][1] for name in statistics):
+        ordered = np.sort(windows, axis=1)
+
+    stats = np.column_stack([WINDOW_STATISTICS[name][0](windows, ordered, count) for name in statistics])
+    stats[count == 0] = np.nan
+    return stats
+
+
+def _window_features(times, values, offsets, sw_width, sw_offset, features, time_window=False):
+    if time_window:
+        traj_idx, starts, win_len, window_id = time_window_bounds(times[0], offsets, sw_width, sw_offset)
+    else:
+        traj_idx, starts, win_len, window_id = window_bounds(np.diff(offsets), sw_width, sw_offset)
+    if len(traj_idx) == 0:
+        return traj_idx, window_id, np.empty((0, len(features)))
+
+    # Deltas of consecutive positions, the windows never cross the trajectory boundaries
+    deltas = _moving_deltas(times, values)
+    delta_starts = offsets[traj_idx] + starts
+    width = int(win_len.max()) - 1
+    mask = np.arange(width) < (win_len - 1)[:, np.newaxis]
+
+    # Only the requested statistics of the requested signals
+    columns = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        for signal, statistics in _feature_plan(features).items():
+            stats = window_statistics(WINDOW_SIGNALS[signal](deltas, delta_starts, mask), statistics)
+            columns.update({(signal, statistic): stats[:, i] for i, statistic in enumerate(statistics)})
+    return traj_idx, window_id, np.column_stack([columns[WINDOW_FEATURES[column]] for column in features])
+
+
+def _shard_window_features(arrays_dir, lo, shard_offsets, sw_width, sw_offset, features, time_window):
+    # Worker: read only the shard positions from the memory mapped arrays
+    times = np.load(os.path.join(arrays_dir, TIMES_FN), mmap_mode="r")
+    values = np.load(os.path.join(arrays_dir, VALUES_FN), mmap_mode="r")
+    begin, end = shard_offsets[0], shard_offsets[-1]
+    traj_idx, window_id, res = _window_features(times[:, begin:end], values[:, begin:end], shard_offsets - begin,
+                                                sw_width, sw_offset, features, time_window)
+    return traj_idx + lo, window_id, res
+
+
+def _parallel_window_features(times, values, offsets, sw_width, sw_offset, features, time_window, n_jobs):
+    bounds = shard_bounds(offsets, n_jobs * SHARDS_PER_JOB)
+    with tempfile.TemporaryDirectory(prefix="moving_behavior_") as arrays_dir:
+        np.save(os.path.join(arrays_dir, TIMES_FN), times)
+        np.save(os.path.join(arrays_dir, VALUES_FN), values)
+
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_shard_window_features, arrays_dir, lo, offsets[lo:hi + 1], sw_width,
+                                       sw_offset, features, time_window)
+                       for lo, hi in zip(bounds[:-1], bounds[1:])]
+            # Shards are ordered by trajectory
+            results = [f.result() for f in futures]
+
+    traj_idx, window_id, res = zip(*results)
+    return np.concatenate(traj_idx), np.concatenate(window_id), np.vstack(res)
+
+
+def moving_behavior_features(pos: pd.DataFrame, groupby, sw_width, sw_offset, n_jobs=None, time_window=False,
+                             features=None):
+    """
+    Moving behavior features of each sliding window of each trajectory.
+
+    Parameters
+    ----------
+    pos : DataFrame
+        positions with the groupby columns and the moving attributes columns
+    groupby : str or list
+        columns that identify a trajectory
+    sw_width : int
+        sliding window width in positions, or in nanoseconds with time_window
+    sw_offset : int
+        sliding window offset in positions, or in nanoseconds with time_window
+    n_jobs : int, optional
+        number of worker processes, the trajectories are split in shards balanced by number of positions and each
+        worker reads the positions from a memory map; None or 1 to run in the current process, -1 for all CPUs
+    time_window : bool
+        True for windows defined by duration on the server time, the positions must be sorted by time inside each
+        trajectory
+    features : list, optional
+        registered window feature columns to calculate, default all the moving behavior features columns; only the
+        requested statistics of the requested signals are calculated
+
+    Returns
+    -------
+    DataFrame
+        groupby columns, moving window id and moving behavior features columns
+    """
+    groupby_cols = groupby if type(groupby) == list else [groupby]
+    features = C.MOVING_BEHAVIOR_FEATURES_COLS if features is None else list(features)
+    out_cols = groupby_cols + [C.MOVING_WINDOW_ID] + features
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+
+    order, keys, offsets = trajectory_offsets(pos, groupby)
+    times, values = _moving_arrays(pos.iloc[order])
+    if n_jobs is not None and n_jobs > 1 and len(keys.index) > 1:
+        traj_idx, window_id, res = _parallel_window_features(times, values, offsets, sw_width, sw_offset, features,
+                                                             time_window, n_jobs)
+    else:
+        traj_idx, window_id, res = _window_features(times, values, offsets, sw_width, sw_offset, features,
+                                                    time_window)
+
+    if len(traj_idx) == 0:
+        return pd.DataFrame(columns=out_cols)
+
+    mbf = keys.iloc[traj_idx].reset_index(drop=True)
+    mbf[C.MOVING_WINDOW_ID] = window_id
+    mbf = pd.concat([mbf, pd.DataFrame(res, columns=features)], axis=1)
+    return mbf[out_cols]
@@ -10,6 +10,7 @@ from util.util import get_elapsed, unzip
 from util.constant import DATA_FOLDER
 
 from .constant import ScooterTrajectoriesC as C
+from .moving_behavior import moving_behavior_features, WINDOW_FEATURES
 
 log = Log(__name__, enable_console=True, enable_file=False)
 
@@ -358,67 +359,64 @@ class ScooterTrajectoriesDS:
         end = time.time()
         return rental_pos_map_df, pos_df, rental_df, get_elapsed(start, end)
 
-    def __moving_attributes(self, trajectory: pd.DataFrame, sw_width, sw_offset):
-        traj_len = len(trajectory.index)
-        sw_width, sw_offset = int(sw_width), int(sw_offset)
-        i = 0
-
-        trajectory_behavior = pd.DataFrame(columns=C.MOVING_BEHAVIOR_FEATURES_COLS)
-
-        while i < traj_len:
-            window = trajectory.iloc[i:i + sw_width][C.MOVING_ATTRIBUTES]
-
-            if len(window.index) > 1:
-                # Get moving attribute for this window.
-                window_curr = window.iloc[1:len(window.index)].reset_index(drop=True)
-                window_prev = window.iloc[0:len(window.index) - 1].reset_index(drop=True)
-                moving_attributes = window_curr.subtract(window_prev)
-
-                delta_t = moving_attributes[[C.POS_GEN_SERVER_TIME_CN, C.POS_GEN_DEVICE_TIME_CN]].mean(axis=1)
-                delta_l = moving_attributes[[C.POS_GEN_LATITUDE_CN, C.POS_GEN_LONGITUDE_CN]]
-                delta_s = moving_attributes[C.POS_GEN_SPEED_CN]
-
-                # Calculate ROT (rate of turn)
-                rot = np.arctan(moving_attributes[C.POS_GEN_LONGITUDE_CN] / moving_attributes[C.POS_GEN_LATITUDE_CN])
-                rot = rot.fillna(0)
-                rot = pd.concat([pd.Series(0), rot], axis=0, ignore_index=True)
-                rot_curr = rot.iloc[1:len(rot.index)].reset_index(drop=True)
-                rot_prev = rot.iloc[0:len(rot.index) - 1].reset_index(drop=True)
-                delta_r = rot_curr.subtract(rot_prev)
-
-                f_delta_l = pd.concat([delta_l[C.POS_GEN_LATITUDE_CN] / (delta_t.astype(np.int64)),
-                                       delta_l[C.POS_GEN_LONGITUDE_CN] / (delta_t.astype(np.int64))], axis=1)
-                f_delta_latitude = f_delta_l[f_delta_l.columns[0]]
-                f_delta_longitude = f_delta_l[f_delta_l.columns[1]]
-                f_delta_s = delta_s
-                f_delta_r = delta_r
-
-                window_mbf = [
-                    # -- f_delta_latitude
-                    f_delta_latitude.mean(), f_delta_latitude.max(), f_delta_latitude.quantile(0.75),
-                    f_delta_latitude.quantile(0.50), f_delta_latitude.quantile(0.25), f_delta_latitude.min(),
-                    # -- f_delta_longitude
-                    f_delta_longitude.mean(), f_delta_longitude.max(), f_delta_longitude.quantile(0.75),
-                    f_delta_longitude.quantile(0.50), f_delta_longitude.quantile(0.25), f_delta_longitude.min(),
-                    # -- f_delta_s
-                    f_delta_s.mean(), f_delta_s.max(), f_delta_s.quantile(0.75), f_delta_s.quantile(0.50),
-                    f_delta_s.quantile(0.25), f_delta_s.min(),
-                    # -- f_delta_r
-                    f_delta_r.mean(), f_delta_r.max(), f_delta_r.quantile(0.75), f_delta_r.quantile(0.50),
-                    f_delta_r.quantile(0.25), f_delta_r.min(),
-                ]
-
-                df_window_mbf = pd.concat([pd.DataFrame([elem]) for elem in window_mbf], axis=1, ignore_index=True)
-                df_window_mbf = df_window_mbf.rename(columns=dict(zip(df_window_mbf.columns,
-                                                                      C.MOVING_BEHAVIOR_FEATURES_COLS)))
-
-                trajectory_behavior = pd.concat([trajectory_behavior, df_window_mbf], axis=0)
-
-            if i + sw_width >= traj_len:
-                break
-            i += sw_offset
-
-        return trajectory_behavior.reset_index(drop=True)
+    def __sliding_window(self, sliding_window_width, sliding_window_offset, time_window):
+        if not time_window:
+            sw_width = sliding_window_width if sliding_window_width else C.SLIDING_WINDOW_WIDTH
+            sw_offset = sliding_window_offset if sliding_window_offset else C.SLIDING_WINDOW_WIDTH / 2
+            return int(sw_width), int(sw_offset)
+
+        # Time windows in nanoseconds: durations as strings or Timedelta, plain numbers as seconds
+        def to_ns(duration):
+            if isinstance(duration, (int, float)) or str(duration).replace(".", "", 1).isdigit():
+                duration = pd.Timedelta(seconds=float(duration))
+            return int(pd.Timedelta(duration).value)
+
+        sw_width = to_ns(sliding_window_width if sliding_window_width else C.SLIDING_WINDOW_DURATION)
+        sw_offset = to_ns(sliding_window_offset) if sliding_window_offset else sw_width // 2
+        return sw_width, sw_offset
+
+    def __stream_checkpoint_load(self, mbf_gen_fp, checkpoint_fp, settings, resume):
+        if resume and os.path.exists(checkpoint_fp) and os.path.exists(mbf_gen_fp):
+            with open(checkpoint_fp, "r") as f:
+                checkpoint = json.load(f)
+            if all(checkpoint.get(k) == v for k, v in settings.items()):
+                # Drop the windows written after the last checkpoint
+                with open(mbf_gen_fp, "r+") as f:
+                    f.truncate(checkpoint["size"])
+                log.i("Resume moving behavior extraction after trajectory {}".format(checkpoint["last"]))
+                return checkpoint["last"]
+            log.w("Moving behavior checkpoint with different settings: restart extraction")
+
+        for fp in [mbf_gen_fp, checkpoint_fp]:
+            if os.path.exists(fp):
+                os.remove(fp)
+        return None
+
+    def __stream_append(self, pos_df, groupby, sw_width, sw_offset, n_jobs, time_window, features, mbf_gen_fp,
+                        checkpoint_fp, settings):
+        if pos_df.empty:
+            return 0
+
+        groupby_cols = groupby if type(groupby) == list else [groupby]
+        mbf = moving_behavior_features(pos_df, groupby, sw_width, sw_offset, n_jobs=n_jobs, time_window=time_window,
+                                       features=features).fillna(0)
+        mbf.to_csv(mbf_gen_fp, mode="a", index=False, header=not os.path.exists(mbf_gen_fp))
+
+        # The positions are sorted by trajectory: the last one is the last trajectory completed
+        last_key = [v.item() if hasattr(v, "item") else v for v in pos_df[groupby_cols].iloc[-1]]
+        checkpoint = dict(settings, last=last_key, size=os.path.getsize(mbf_gen_fp))
+        with open(checkpoint_fp, "w") as f:
+            json.dump(checkpoint, f)
+        return len(mbf.index)
+
+    def __key_less_equal(self, df, cols, key):
+        # Lexicographic comparison of the trajectory keys
+        less = pd.Series(False, index=df.index)
+        equal = pd.Series(True, index=df.index)
+        for cn, value in zip(cols, key):
+            less = less | (equal & (df[cn] < value))
+            equal = equal & (df[cn] == value)
+        return less | equal
 
     def generate(self, chunknum=0, chunksize=50000):
         log.d("Scooter Trajectories start unzip")
@@ -760,26 +758,111 @@ class ScooterTrajectoriesDS:
         log.d("elapsed time: {}".format(get_elapsed(start, end)))
         return self
 
-    def moving_behavior_feature_extraction(self, groupby, sliding_window_width=None, sliding_window_offset=None):
+    def moving_behavior_feature_extraction(self, groupby, sliding_window_width=None, sliding_window_offset=None,
+                                           n_jobs=None, time_window=False, features=None):
         log.d("Scooter Trajectories moving behavior feature extraction algorithm")
+        if features is not None and not set(features) <= set(WINDOW_FEATURES):
+            log.e("Moving behavior features {} not registered".format(sorted(set(features) - set(WINDOW_FEATURES))))
+            return self
         start = time.time()
 
-        sw_width = sliding_window_width if sliding_window_width else C.SLIDING_WINDOW_WIDTH
-        sw_offset = sliding_window_offset if sliding_window_offset else C.SLIDING_WINDOW_WIDTH / 2
-        sw_width, sw_offset = int(sw_width), int(sw_offset)
+        # Sliding window in positions, or in time with time_window: the positions are sorted by server time
+        sw_width, sw_offset = self.__sliding_window(sliding_window_width, sliding_window_offset, time_window)
 
-        # Group position in trajectories
-        pos_groups = self.pos.groupby(by=groupby)
-        res = pos_groups.apply(lambda x: self.__moving_attributes(x, sw_width=sw_width, sw_offset=sw_offset))
-        res = res.reset_index(drop=False)
-        res = res.rename(columns={res.columns[2]: C.MOVING_WINDOW_ID})
-        self.moving_behavior_features = res
+        # Sliding windows of all the trajectories at once
+        self.moving_behavior_features = moving_behavior_features(self.pos, groupby, sw_width, sw_offset,
+                                                                 n_jobs=n_jobs, time_window=time_window,
+                                                                 features=features)
         self.moving_behavior_features = self.moving_behavior_features.fillna(0)
 
         end = time.time()
         log.d("elapsed time: {}".format(get_elapsed(start, end)))
         return self
 
+    def moving_behavior_feature_extraction_stream(self, groupby, sliding_window_width=None,
+                                                  sliding_window_offset=None, chunksize=500000, resume=True,
+                                                  n_jobs=None, time_window=False, features=None):
+        """
+        Moving behavior feature extraction that streams the generated positions file in chunks and appends the
+        window features of each chunk to the generated moving behavior features file. Only a chunk and the last rental
+        of the previous chunk are kept in memory. The last completed trajectory is saved in a checkpoint file after
+        each chunk, so an interrupted run resumes from it.
+
+        Parameters
+        ----------
+        groupby : str or list
+            columns that identify a trajectory, the first one must be the rental id
+        sliding_window_width : int or str, optional
+            sliding window width in positions, or duration with time_window (e.g. "60s", numbers as seconds)
+        sliding_window_offset : int or str, optional
+            sliding window offset in positions, or duration with time_window
+        chunksize : int
+            number of positions read for each chunk
+        resume : bool
+            True to resume from the checkpoint, False to restart from the first trajectory
+        n_jobs : int, optional
+            number of worker processes for each chunk
+        time_window : bool
+            True for sliding windows defined by duration on the server time instead of number of positions
+        features : list, optional
+            registered window feature columns to calculate, default all the moving behavior features columns
+
+        Returns
+        -------
+        ScooterTrajectoriesDS
+            self, the moving behavior features are not kept in memory
+        """
+        log.d("Scooter Trajectories moving behavior feature extraction algorithm in streaming")
+        if features is not None and not set(features) <= set(WINDOW_FEATURES):
+            log.e("Moving behavior features {} not registered".format(sorted(set(features) - set(WINDOW_FEATURES))))
+            return self
+        start = time.time()
+
+        sw_width, sw_offset = self.__sliding_window(sliding_window_width, sliding_window_offset, time_window)
+        groupby_cols = groupby if type(groupby) == list else [groupby]
+
+        pos_gen_fp = os.path.join(DATA_FOLDER, C.GENERATED_DN, C.CSV_POS_GENERATED_FN)
+        if not os.path.exists(pos_gen_fp):
+            log.e("{} path not exist: impossible to stream positions".format(pos_gen_fp))
+            return self
+
+        mbf_gen_fp = os.path.join(DATA_FOLDER, C.GENERATED_DN, C.CSV_MOVING_BEHAVIOR_FEATURE)
+        checkpoint_fp = os.path.join(DATA_FOLDER, C.GENERATED_DN, C.JSON_MOVING_BEHAVIOR_FEATURE_CHECKPOINT)
+        # The positions file size and modification time identify the input: a regenerated file restarts extraction
+        settings = {"groupby": groupby_cols, "sliding_window_width": sw_width, "sliding_window_offset": sw_offset,
+                    "time_window": time_window,
+                    "features": list(features) if features is not None else C.MOVING_BEHAVIOR_FEATURES_COLS,
+                    "pos_gen": [os.path.getsize(pos_gen_fp), os.stat(pos_gen_fp).st_mtime_ns]}
+        last_key = self.__stream_checkpoint_load(mbf_gen_fp, checkpoint_fp, settings, resume)
+
+        reader = pd.read_csv(pos_gen_fp, usecols=groupby_cols + C.MOVING_ATTRIBUTES, parse_dates=C.POS_GEN_TIME_COLS,
+                             chunksize=chunksize, iterator=True, memory_map=True)
+        carry = pd.DataFrame()
+        windows_num = 0
+        for curr_chunk, pos_chunk_df in enumerate(reader):
+            # Skip the trajectories already completed
+            if last_key is not None:
+                pos_chunk_df = pos_chunk_df.loc[~self.__key_less_equal(pos_chunk_df, groupby_cols, last_key)]
+
+            # The last rental can continue in the next chunk: keep it for the next one
+            chunk = pd.concat([carry, pos_chunk_df], axis=0, ignore_index=True)
+            if chunk.empty:
+                continue
+            is_last_rental = chunk[groupby_cols[0]] == chunk[groupby_cols[0]].iloc[-1]
+            carry = chunk.loc[is_last_rental]
+            windows_num += self.__stream_append(chunk.loc[~is_last_rental], groupby, sw_width, sw_offset, n_jobs,
+                                                time_window, features, mbf_gen_fp, checkpoint_fp, settings)
+            log.d("__chunk {} moving behavior windows: {}".format(curr_chunk, windows_num))
+
+        reader.close()
+        windows_num += self.__stream_append(carry, groupby, sw_width, sw_offset, n_jobs, time_window, features,
+                                            mbf_gen_fp, checkpoint_fp, settings)
+        log.d("moving behavior windows: {}".format(windows_num))
+
+        end = time.time()
+        log.d("elapsed time: {}".format(get_elapsed(start, end)))
+        return self
+
     def heuristic_empty(self):
         """
         Heuristic columns are empty if there is a value of heuristic columns that is null.
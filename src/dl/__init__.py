@@ -1,7 +1,9 @@
-from .deep_clustering import DeepClustering
+from .deep_clustering import DeepClustering, TrajectoryDeepClustering, ParallelDeepClustering
+from .window_store import WindowStore, windows_fingerprint
+from .export import export_encoder, EncoderModule
 
 from .deep_clustering import AutoEncoder
-from .deep_clustering import RegressiveAutoEncoder, AddonsAutoEncoder, SimpleAutoEncoder
+from .deep_clustering import RegressiveAutoEncoder, AddonsAutoEncoder, SimpleAutoEncoder, MultiDecoderAutoEncoder
 
 from .deep_clustering import LSTMEncoder
 from .deep_clustering import LSTMDecoder, LSTMAddonsDecoder, LSTMAutoregressiveDecoder
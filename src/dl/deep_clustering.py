@@ -1,13 +1,55 @@
+import os
+import hashlib
+import tempfile
+import multiprocessing
 import tensorflow as tf
 import tensorflow_addons as tfa
 import pandas as pd
 import numpy as np
 
+from concurrent.futures import ProcessPoolExecutor
+
 from util.util import get_elapsed
 from util.log import Log
+from .window_store import trajectory_windows, WindowStore
+from .export import export_encoder
 
 log = Log(__name__, enable_console=True, enable_file=False)
 
+# Global training: maximum number of windows of a training sequence
+GLOBAL_SEQ_LEN = 64
+# Per-trajectory training: trajectories sent to a worker at once and trajectories between progress logs
+TRAJECTORIES_PER_TASK = 8
+PROGRESS_TRAJECTORIES = 100
+# Per-trajectory training with the tuned input pipeline: default number of sequences for each batch
+TUNED_PIPELINE_BATCH_SZ = 32
+# Memory mapped window features shared with the workers
+VALUES_FN = "values.npy"
+# Per-trajectory latent cache: column of the trajectory content and hyperparameters hash
+CONTENT_HASH_CN = "content_hash"
+# Decoder types, "multi" trains the decoders in MULTI_DECODERS on a shared encoder
+MULTI_DECODERS = ["simple", "autoregressive", "addons"]
+AUTOENCODER_MODELS = MULTI_DECODERS + ["multi"]
+
+
+def _valid_lengths(mask):
+    # Number of valid windows of each sequence
+    return tf.reduce_sum(tf.cast(mask, tf.int32), axis=1)
+
+
+def _pad_end(x, lengths):
+    # Sequences padded at the beginning moved to the start of the time axis, padded at the end
+    time_dim = tf.shape(x)[1]
+    src = tf.range(time_dim)[tf.newaxis, :] + (time_dim - lengths)[:, tf.newaxis]
+    return tf.gather(x, tf.minimum(src, time_dim - 1), batch_dims=1)
+
+
+def _pad_beginning(x, lengths):
+    # Sequences padded at the end moved to the end of the time axis, padded at the beginning as the inputs
+    time_dim = tf.shape(x)[1]
+    src = tf.range(time_dim)[tf.newaxis, :] - (time_dim - lengths)[:, tf.newaxis]
+    return tf.gather(x, tf.maximum(src, 0), batch_dims=1)
+
 
 class LSTMEncoder(tf.keras.layers.Layer):
     def __init__(self, enc_units, batch_sz=1, name="lstm_encoder", **kwargs):
@@ -16,12 +58,13 @@ class LSTMEncoder(tf.keras.layers.Layer):
         self.enc_units = enc_units
         self.lstm = tf.keras.layers.LSTM(self.enc_units, return_state=True, return_sequences=True)
 
-    def call(self, x, hidden=None, training=None):
-        output, state_m, state_c = self.lstm(x, initial_state=hidden, training=training)
+    def call(self, x, hidden=None, training=None, mask=None):
+        output, state_m, state_c = self.lstm(x, initial_state=hidden, training=training, mask=mask)
         return output, state_m, state_c
 
-    def initialize_hidden_state(self):
-        return [tf.zeros((self.batch_sz, self.enc_units)), tf.zeros((self.batch_sz, self.enc_units))]
+    def initialize_hidden_state(self, batch_sz=None):
+        batch_sz = self.batch_sz if batch_sz is None else batch_sz
+        return [tf.zeros((batch_sz, self.enc_units)), tf.zeros((batch_sz, self.enc_units))]
 
     def get_config(self):
         config = super(LSTMEncoder, self).get_config()
@@ -38,8 +81,8 @@ class LSTMDecoder(tf.keras.layers.Layer):
         self.lstm = tf.keras.layers.LSTM(self.dec_units, return_state=True, return_sequences=True)
         self.dense_output = tf.keras.layers.Dense(self.output_units, activation=tf.nn.relu)
 
-    def call(self, x, hidden=None, training=None):
-        output, _, _ = self.lstm(x, initial_state=hidden, training=training)
+    def call(self, x, hidden=None, training=None, mask=None):
+        output, _, _ = self.lstm(x, initial_state=hidden, training=training, mask=mask)
         output = self.dense_output(output, training=training)
         return output
 
@@ -63,9 +106,20 @@ class LSTMAddonsDecoder(tf.keras.layers.Layer):
         self.decoder_cell = tf.keras.layers.LSTMCell(dec_units)
         self.decoder = tfa.seq2seq.BasicDecoder(self.decoder_cell, self.sampler, self.dense_output)
 
-    def call(self, x, hidden=None, training=None):
-        output, _, _ = self.decoder(x, initial_state=hidden, training=training)
-        return output.rnn_output
+    def call(self, x, hidden=None, training=None, mask=None):
+        if mask is None:
+            output, _, _ = self.decoder(tf.identity(x), initial_state=hidden, training=training)
+            return output.rnn_output
+
+        # The sampler supports only sequences padded at the end: the valid windows are decoded first from the encoder
+        # state, then the outputs are moved back in place of the valid windows
+        lengths = _valid_lengths(mask)
+        output, _, _ = self.decoder(_pad_end(x, lengths), initial_state=hidden, training=training,
+                                    sequence_length=lengths)
+        # The decoding stops at the longest sequence of the batch
+        output = output.rnn_output
+        output = tf.pad(output, [[0, 0], [0, tf.shape(x)[1] - tf.shape(output)[1]], [0, 0]])
+        return _pad_beginning(output, lengths)
 
     def get_config(self):
         config = super(LSTMAddonsDecoder, self).get_config()
@@ -96,27 +150,33 @@ class LSTMAutoregressiveDecoder(tf.keras.layers.Layer):
         prediction = self.dense_output(prediction, training=training)
         return prediction, state
 
-    def call(self, last_input, hidden=None, training=None):
-        # Use a TensorArray to capture dynamically unrolled outputs.
-        predictions = []
+    def call(self, last_input, hidden=None, training=None, mask=None):
         # Initialize the lstm state
         x, state = self.warmup(last_input, hidden, training=training)
+        # Use a TensorArray to capture dynamically unrolled outputs.
+        predictions = tf.TensorArray(x.dtype, size=self.output_steps, element_shape=x.shape)
         # Insert the first prediction
-        predictions.append(x)
+        predictions = predictions.write(0, x)
 
-        # Run the rest of the prediction steps
-        for n in range(1, self.output_steps):
+        def step(n, x, state, predictions):
             # Execute one lstm step.
             x, state = self.lstm_cell(x, states=state, training=training)
             x = self.dense_output(x, training=training)
 
             # Add the prediction to the output
-            predictions.append(x)
+            return n + 1, x, state, predictions.write(n, x)
+
+        # Run the rest of the prediction steps as a symbolic loop: the graph size does not depend on the steps
+        _, _, _, predictions = tf.while_loop(lambda n, x, state, predictions: n < self.output_steps, step,
+                                             (tf.constant(1), x, state, predictions))
 
         # predictions.shape => (time, batch, features)
-        predictions = tf.stack(predictions)
+        predictions = predictions.stack()
         # predictions.shape => (batch, time, features)
         predictions = tf.transpose(predictions, [1, 0, 2])
+        if mask is not None:
+            # Step k of a sequence padded at the beginning reconstructs its k-th valid window
+            predictions = _pad_beginning(predictions, _valid_lengths(mask))
         return predictions
 
     def get_config(self):
@@ -140,11 +200,11 @@ class AutoEncoder(tf.keras.Model):
         self.decoder = None
         self.state = None
 
-    def call(self, x, hidden=None, training=None):
-        init_state = self.encoder.initialize_hidden_state()
-        encoded, state_m, state_c = self.encoder(x, hidden=init_state, training=training)
+    def call(self, x, hidden=None, training=None, mask=None):
+        init_state = self.encoder.initialize_hidden_state(tf.shape(x)[0])
+        encoded, state_m, state_c = self.encoder(x, hidden=init_state, training=training, mask=mask)
         self.state = [state_m, state_c]
-        decoded = self.decoder(encoded, hidden=self.state, training=training)
+        decoded = self.decoder(encoded, hidden=self.state, training=training, mask=mask)
         return decoded
 
     def get_config(self):
@@ -154,14 +214,16 @@ class AutoEncoder(tf.keras.Model):
         return config
 
     def train_step(self, data):
-        # Unpack the data.
-        x = data
+        # Unpack the data: padded sequences come with the mask of the valid windows
+        x, mask = data if isinstance(data, tuple) else (data, None)
+        sample_weight = None if mask is None else tf.cast(mask, x.dtype)
 
         with tf.GradientTape() as tape:
             # Forward pass
-            x_pred = self(x, training=True)
-            # Compute the loss value
-            loss = self.compiled_loss(x, x_pred, regularization_losses=self.losses)
+            x_pred = self(x, training=True, mask=mask)
+            # Compute the loss value, the padding does not contribute; every decoded output reconstructs x
+            y, sample_weight = self._targets(x, x_pred, sample_weight)
+            loss = self.compiled_loss(y, x_pred, sample_weight=sample_weight, regularization_losses=self.losses)
 
         # Compute gradients
         trainable_vars = self.trainable_weights
@@ -169,16 +231,43 @@ class AutoEncoder(tf.keras.Model):
         # Update weights
         self.optimizer.apply_gradients(zip(gradients, trainable_vars))
         # Update metrics (includes the metric that tracks the loss)
-        self.compiled_metrics.update_state(x, x_pred)
+        self.compiled_metrics.update_state(y, x_pred, sample_weight=sample_weight)
         # Return a dict mapping metric names to current value
         return {m.name: m.result() for m in self.metrics}
 
+    @staticmethod
+    def _targets(x, x_pred, sample_weight):
+        if not isinstance(x_pred, (list, tuple)):
+            return x, sample_weight
+        return [x] * len(x_pred), None if sample_weight is None else [sample_weight] * len(x_pred)
+
     def get_state(self):
         if not self.state:
             log.e("AutoEncoder state is None")
             return None
         return self.state
 
+    def encode(self, x, mask=None):
+        """
+        Latent state of each sequence, running only the encoder in inference mode.
+
+        Parameters
+        ----------
+        x : ndarray or Tensor
+            (sequences, time, features) batch of sequences, padded at the beginning if they have different lengths
+        mask : ndarray or Tensor, optional
+            (sequences, time) mask of the valid windows
+
+        Returns
+        -------
+        Tensor
+            (sequences, 2 * latent_dim) final encoder states, state_m followed by state_c
+        """
+        x = tf.convert_to_tensor(x, dtype=tf.float32)
+        init_state = self.encoder.initialize_hidden_state(tf.shape(x)[0])
+        _, state_m, state_c = self.encoder(x, hidden=init_state, training=False, mask=mask)
+        return tf.concat([state_m, state_c], axis=-1)
+
 
 class RegressiveAutoEncoder(AutoEncoder):
     def __init__(self, time_dim, feature_dim, latent_dim=1, name="regressive_autoencoder", **kwargs):
@@ -187,11 +276,12 @@ class RegressiveAutoEncoder(AutoEncoder):
                                                  output_steps=self.time_dim,
                                                  output_units=self.feature_dim)
 
-    def call(self, x, hidden=None, training=None):
-        init_state = self.encoder.initialize_hidden_state()
-        encoded, state_m, state_c = self.encoder(x, hidden=init_state, training=training)
+    def call(self, x, hidden=None, training=None, mask=None):
+        init_state = self.encoder.initialize_hidden_state(tf.shape(x)[0])
+        encoded, state_m, state_c = self.encoder(x, hidden=init_state, training=training, mask=mask)
         self.state = [state_m, state_c]
-        decoded = self.decoder(x[:, -1, :], hidden=self.state, training=training)
+        # The sequences are padded at the beginning: the last window is always valid
+        decoded = self.decoder(x[:, -1, :], hidden=self.state, training=training, mask=mask)
         return decoded
 
     def train_step(self, data):
@@ -204,8 +294,8 @@ class AddonsAutoEncoder(AutoEncoder):
         self.decoder = LSTMAddonsDecoder(dec_units=self.latent_dim,
                                          output_units=self.feature_dim)
 
-    def call(self, x, hidden=None, training=None):
-        return super(AddonsAutoEncoder, self).call(x, hidden, training)
+    def call(self, x, hidden=None, training=None, mask=None):
+        return super(AddonsAutoEncoder, self).call(x, hidden, training, mask)
 
     def train_step(self, data):
         return super(AddonsAutoEncoder, self).train_step(data)
@@ -217,33 +307,129 @@ class SimpleAutoEncoder(AutoEncoder):
         self.decoder = LSTMDecoder(dec_units=self.latent_dim,
                                    output_units=self.feature_dim)
 
-    def call(self, x, hidden=None, training=None):
-        return super(SimpleAutoEncoder, self).call(x, hidden, training)
+    def call(self, x, hidden=None, training=None, mask=None):
+        return super(SimpleAutoEncoder, self).call(x, hidden, training, mask)
 
     def train_step(self, data):
         return super(SimpleAutoEncoder, self).train_step(data)
 
 
+class MultiDecoderAutoEncoder(AutoEncoder):
+    """
+    Autoencoder with one shared encoder and several decoders, trained jointly on the sum of the reconstruction
+    losses: a single encoder pass per batch feeds all the decoders.
+
+    decoders: list of "autoregressive", "addons", "simple"
+    """
+    def __init__(self, time_dim, feature_dim, latent_dim=1, decoders=None, name="multi_decoder_autoencoder",
+                 **kwargs):
+        super(MultiDecoderAutoEncoder, self).__init__(time_dim, feature_dim, latent_dim, name, **kwargs)
+        self.decoder_names = list(decoders) if decoders else list(MULTI_DECODERS)
+        self.decoders = [self.__decoder(d) for d in self.decoder_names]
+
+    def __decoder(self, decoder):
+        if decoder == "autoregressive":
+            return LSTMAutoregressiveDecoder(dec_units=self.latent_dim, output_steps=self.time_dim,
+                                             output_units=self.feature_dim)
+        elif decoder == "addons":
+            return LSTMAddonsDecoder(dec_units=self.latent_dim, output_units=self.feature_dim)
+        return LSTMDecoder(dec_units=self.latent_dim, output_units=self.feature_dim)
+
+    def call(self, x, hidden=None, training=None, mask=None):
+        init_state = self.encoder.initialize_hidden_state(tf.shape(x)[0])
+        encoded, state_m, state_c = self.encoder(x, hidden=init_state, training=training, mask=mask)
+        self.state = [state_m, state_c]
+        decoded = []
+        for name, decoder in zip(self.decoder_names, self.decoders):
+            if name == "autoregressive":
+                # The sequences are padded at the beginning: the last window is always valid
+                decoded.append(decoder(x[:, -1, :], hidden=self.state, training=training, mask=mask))
+            else:
+                decoded.append(decoder(encoded, hidden=self.state, training=training, mask=mask))
+        return decoded
+
+    def get_config(self):
+        config = super(MultiDecoderAutoEncoder, self).get_config()
+        config.update({"decoders": self.decoder_names})
+        return config
+
+    def train_step(self, data):
+        return super(MultiDecoderAutoEncoder, self).train_step(data)
+
+
+def enable_eager_mode():
+    # Debug mode: every tf.function and tf.data transformation runs op by op for the whole process
+    tf.config.run_functions_eagerly(True)
+    tf.data.experimental.enable_debug_mode()
+
+
+def build_autoencoder(model, time_dim, feature_dim, latent_dim):
+    if model == "autoregressive":
+        return RegressiveAutoEncoder(time_dim, feature_dim, latent_dim=latent_dim)
+    elif model == "addons":
+        return AddonsAutoEncoder(time_dim, feature_dim, latent_dim=latent_dim)
+    elif model == "multi":
+        return MultiDecoderAutoEncoder(time_dim, feature_dim, latent_dim=latent_dim)
+    return SimpleAutoEncoder(time_dim, feature_dim, latent_dim=latent_dim)
+
+
+def window_dataset(values, seq_len, batch_sz):
+    """
+    Tuned input pipeline of the overlapping sequences of seq_len consecutive windows: the sequences are gathered
+    in parallel from a single copy of the values, cached after the first epoch, shuffled at each epoch, batched and
+    prefetched while the model trains.
+
+    Parameters
+    ----------
+    values : ndarray
+        (windows, features) window features, also memory mapped
+    seq_len : int
+        number of windows of a sequence
+    batch_sz : int
+        number of sequences for each batch
+
+    Returns
+    -------
+    Dataset
+        batches of (batch, seq_len, features) sequences
+    """
+    n_sequences = len(values) - seq_len + 1
+    values = tf.constant(values, dtype=tf.float32)
+    steps = tf.range(seq_len, dtype=tf.int64)
+    dataset = tf.data.Dataset.range(n_sequences)
+    dataset = dataset.map(lambda start: tf.gather(values, start + steps), num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.cache().shuffle(n_sequences, reshuffle_each_iteration=True)
+    return dataset.batch(batch_sz).prefetch(tf.data.AUTOTUNE)
+
+
 class DeepClustering:
-    def __init__(self, data: pd.DataFrame, latent_dim, hidden_dim=None,
-                 model="autoregressive", epoch=10, batch_sz=1):
-        # Tensorflow config
-        tf.config.run_functions_eagerly(True)
-        tf.data.experimental.enable_debug_mode()
+    def __init__(self, data, latent_dim, hidden_dim=None,
+                 model="autoregressive", epoch=10, batch_sz=1, eager=False, tuned_pipeline=False):
+        # Tensorflow config: the eager and debug modes are process-global, only on request
+        self.eager = eager
+        if self.eager:
+            enable_eager_mode()
+
+        # Window features as DataFrame or array, also memory mapped
+        values = data.to_numpy(dtype=np.float32) if isinstance(data, pd.DataFrame) else \
+            np.asarray(data, dtype=np.float32)
 
         # Attributes assignment
-        self.seq_len = max(int(len(data.index) / 2), 1)
+        self.seq_len = max(int(len(values) / 2), 1)
         self.latent_dim = latent_dim
         self.hidden_dim = hidden_dim
-        self.model = model if model in ["autoregressive", "addons", "simple"] else "simple"
+        self.model = model if model in AUTOENCODER_MODELS else "simple"
         self.epoch = epoch
         self.batch_sz = batch_sz
-        self.features_len = len(data.columns)
+        self.features_len = values.shape[1]
 
         # Data
-        if len(data.index) > 1:
+        self.last_sequence = np.expand_dims(values[-self.seq_len:], axis=0)
+        if len(values) > 1 and tuned_pipeline:
+            self.data = window_dataset(values, self.seq_len, batch_sz)
+        elif len(values) > 1:
             self.data = tf.keras.preprocessing.timeseries_dataset_from_array(
-                data=data.to_numpy(),
+                data=values,
                 targets=None,
                 sequence_length=self.seq_len,
                 sequence_stride=1,
@@ -251,11 +437,11 @@ class DeepClustering:
                 batch_size=batch_sz)
             # self.data = self.data.map(lambda x: (x, x))
         else:
-            data_np = np.expand_dims(data.values, axis=0)
+            data_np = np.expand_dims(values, axis=0)
             self.data = tf.data.Dataset.from_tensor_slices(data_np).batch(batch_sz)
         self.ae = None
 
-    def train(self, patience=2):
+    def train(self, patience=2, verbose="auto"):
         """
         optimizer = tf.keras.optimizers.Adam()
         mse_loss_fn = tf.keras.losses.MeanSquaredError()
@@ -283,19 +469,15 @@ class DeepClustering:
                 log.i("step %d: loss %.4f; mae = %.4f" % (step, loss, loss_metric.result()))
         return
         """
-        if self.model == "autoregressive":
-            self.ae = RegressiveAutoEncoder(self.seq_len, self.features_len, latent_dim=self.latent_dim)
-        elif self.model == "simple":
-            self.ae = SimpleAutoEncoder(self.seq_len, self.features_len, latent_dim=self.latent_dim)
-        elif self.model == "addons":
-            self.ae = AddonsAutoEncoder(self.seq_len, self.features_len, latent_dim=self.latent_dim)
+        self.ae = build_autoencoder(self.model, self.seq_len, self.features_len, self.latent_dim)
 
         early_stopping = tf.keras.callbacks.EarlyStopping(monitor="loss",
                                                           patience=patience,
                                                           mode="min")
-        self.ae.compile(loss=tf.keras.losses.MeanSquaredError(), run_eagerly=True,
+        # Without eager mode the train step and the decoders run as a compiled graph
+        self.ae.compile(loss=tf.keras.losses.MeanSquaredError(), run_eagerly=self.eager,
                         optimizer=tf.keras.optimizers.Adam(learning_rate=1e-3))
-        history = self.ae.fit(self.data, epochs=self.epoch, callbacks=[early_stopping])
+        history = self.ae.fit(self.data, epochs=self.epoch, callbacks=[early_stopping], verbose=verbose)
         return history
 
     def get_train_state(self):
@@ -303,6 +485,279 @@ class DeepClustering:
         return train_loss, train_acc
 
     def get_latent_state(self):
-        state = self.ae.get_state()
-        # Flat the state tuple of list.
-        return pd.Series([s for sub in state for s in sub[-1].numpy()])
+        # Encoder state of the last sequence of the trajectory
+        return pd.Series(self.ae.encode(self.last_sequence)[0].numpy())
+
+
+class TrajectoryDeepClustering:
+    """
+    Deep clustering with a single autoencoder shared by all the trajectories. Each trajectory is a sequence of
+    windows split in training sequences of at most seq_len windows, padded at the beginning and masked, so that the
+    autoencoder is trained over large batches of all the trajectories. The latent state of each trajectory is taken
+    in a single batched inference pass over the whole trajectory sequences, sorted by length so that each batch is
+    padded only to its longest trajectory.
+
+    Parameters
+    ----------
+    data : DataFrame or WindowStore
+        windows with the groupby columns and the feature columns, sorted by window inside each trajectory, or a
+        loaded window store
+    groupby : str or list
+        columns that identify a trajectory
+    feature_cols : list
+        feature columns of the windows
+    latent_dim : int
+        number of units of the encoder state
+    hidden_dim : int, optional
+        not used, as DeepClustering
+    model : str
+        decoder type: "autoregressive", "addons", "simple", "multi" for all of them on a shared encoder
+    epoch : int
+        number of epochs
+    batch_sz : int
+        number of sequences for each batch
+    seq_len : int, optional
+        maximum number of windows of a training sequence, default the longest trajectory up to GLOBAL_SEQ_LEN
+    eager : bool
+        True to run the training op by op in eager and tf.data debug mode, False to run it as a compiled graph
+    """
+    def __init__(self, data: pd.DataFrame, groupby, feature_cols, latent_dim, hidden_dim=None,
+                 model="autoregressive", epoch=10, batch_sz=256, seq_len=None, eager=False):
+        # Tensorflow config: the eager and debug modes are process-global, only on request
+        self.eager = eager
+        if self.eager:
+            enable_eager_mode()
+
+        # Attributes assignment
+        self.groupby = groupby if type(groupby) == list else [groupby]
+        self.latent_dim = latent_dim
+        self.hidden_dim = hidden_dim
+        self.model = model if model in AUTOENCODER_MODELS else "simple"
+        self.epoch = epoch
+        self.batch_sz = batch_sz
+        self.features_len = len(feature_cols)
+
+        self.keys, self.values, self.offsets = trajectory_windows(data, self.groupby, feature_cols)
+        lengths = np.diff(self.offsets)
+        self.seq_len = int(min(lengths.max(), seq_len if seq_len else GLOBAL_SEQ_LEN)) if len(lengths) else 1
+
+        # Training sequences: each trajectory split in chunks of seq_len windows
+        counts = -(-lengths // self.seq_len)
+        chunk_traj = np.repeat(np.arange(len(lengths)), counts)
+        chunk_start = self.offsets[chunk_traj] + \
+            (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)) * self.seq_len
+        chunk_len = np.minimum(self.seq_len, self.offsets[chunk_traj + 1] - chunk_start)
+        x, mask = self.__padded(chunk_start, chunk_len, self.seq_len)
+        self.data = tf.data.Dataset.from_tensor_slices((x, mask)).shuffle(len(x)).batch(batch_sz) \
+            .prefetch(tf.data.AUTOTUNE)
+        self.ae = None
+
+    def __padded(self, starts, lengths, width):
+        # Sequences padded at the beginning, so that the last window of each sequence is valid
+        src = np.arange(width) - (width - lengths)[:, np.newaxis]
+        mask = src >= 0
+        x = self.values[np.where(mask, starts[:, np.newaxis] + src, 0)]
+        x[~mask] = 0
+        return x, mask
+
+    def train(self, patience=2):
+        self.ae = build_autoencoder(self.model, self.seq_len, self.features_len, self.latent_dim)
+
+        early_stopping = tf.keras.callbacks.EarlyStopping(monitor="loss",
+                                                          patience=patience,
+                                                          mode="min")
+        # Without eager mode the train step and the decoders run as a compiled graph
+        self.ae.compile(loss=tf.keras.losses.MeanSquaredError(), run_eagerly=self.eager,
+                        optimizer=tf.keras.optimizers.Adam(learning_rate=1e-3))
+        history = self.ae.fit(self.data, epochs=self.epoch, callbacks=[early_stopping])
+        return history
+
+    def get_latent_state(self):
+        """
+        Latent state of each trajectory: final encoder state over the whole trajectory sequence.
+
+        Returns
+        -------
+        DataFrame
+            groupby columns and the latent state columns (state_m and state_c of each encoder unit)
+        """
+        if self.ae is None:
+            log.e("TrajectoryDeepClustering latent state: you have to train the autoencoder earlier")
+            return pd.DataFrame()
+
+        lengths = np.diff(self.offsets)
+        by_length = np.argsort(lengths, kind="stable")
+        states = np.empty((len(lengths), 2 * self.latent_dim), dtype=np.float32)
+        for lo in range(0, len(lengths), self.batch_sz):
+            batch = by_length[lo:lo + self.batch_sz]
+            x, mask = self.__padded(self.offsets[batch], lengths[batch], int(lengths[batch].max()))
+            states[batch] = self.ae.encode(x, mask=mask).numpy()
+
+        latent_cols = ["state_m" + str(i) for i in range(self.latent_dim)] + \
+                      ["state_c" + str(i) for i in range(self.latent_dim)]
+        return pd.concat([self.keys, pd.DataFrame(states, columns=latent_cols)], axis=1)
+
+    def export(self, export_dir, tflite=True, quantize=True):
+        """
+        Export the trained encoder as SavedModel and TFLite, see export_encoder.
+        """
+        if self.ae is None:
+            log.e("TrajectoryDeepClustering export: you have to train the autoencoder earlier")
+            return None
+        return export_encoder(self.ae, export_dir, tflite=tflite, quantize=quantize)
+
+
+def _init_worker(tf_threads):
+    # Bounded TensorFlow thread pools, set before the worker runtime starts
+    tf.config.threading.set_intra_op_parallelism_threads(tf_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(tf_threads)
+
+
+def _train_trajectories(values, bounds, latent_dim, hidden_dim, model, epoch, batch_sz, eager, tuned_pipeline):
+    # Worker: a new autoencoder for each trajectory, the windows are read from the memory map without copies
+    if isinstance(values, str):
+        values = np.load(values, mmap_mode="r")
+    states = []
+    for lo, hi in bounds:
+        dc = DeepClustering(values[lo:hi], latent_dim, hidden_dim=hidden_dim, model=model, epoch=epoch,
+                            batch_sz=batch_sz, eager=eager, tuned_pipeline=tuned_pipeline)
+        dc.train(verbose=0)
+        states.append(dc.get_latent_state().to_numpy())
+    return states
+
+
+class ParallelDeepClustering:
+    """
+    Deep clustering with an autoencoder for each trajectory, trained concurrently by a pool of worker processes
+    with bounded TensorFlow threads. The latent states are collected in trajectory order and appended to a cache
+    file keyed by the hash of the trajectory windows and of the model hyperparameters: an interrupted run resumes
+    from the trajectories not yet trained and a later run trains only the new or changed trajectories.
+
+    Parameters
+    ----------
+    data : DataFrame or WindowStore
+        windows with the groupby columns and the feature columns, sorted by window inside each trajectory, or a
+        loaded window store
+    groupby : str or list
+        columns that identify a trajectory
+    feature_cols : list
+        feature columns of the windows
+    latent_dim : int
+        number of units of the encoder state
+    hidden_dim : int, optional
+        not used, as DeepClustering
+    model : str
+        decoder type: "autoregressive", "addons", "simple", "multi" for all of them on a shared encoder
+    epoch : int
+        number of epochs
+    batch_sz : int, optional
+        number of sequences for each batch, default TUNED_PIPELINE_BATCH_SZ with the tuned pipeline and 1 without
+    n_jobs : int, optional
+        number of worker processes; None or 1 to train in the current process, -1 for all CPUs
+    tf_threads : int
+        TensorFlow intra-op and inter-op threads of each worker
+    cache_fp : str, optional
+        csv file with the latent states of the trained trajectories by content hash, None to disable the cache
+    eager : bool
+        True to run the training op by op in eager and tf.data debug mode, False to run it as a compiled graph
+    tuned_pipeline : bool
+        True to feed each model with the cached, batched and prefetched window_dataset
+    """
+    def __init__(self, data: pd.DataFrame, groupby, feature_cols, latent_dim, hidden_dim=None,
+                 model="autoregressive", epoch=10, batch_sz=None, n_jobs=None, tf_threads=1, cache_fp=None,
+                 eager=False, tuned_pipeline=False):
+        self.groupby = groupby if type(groupby) == list else [groupby]
+        self.latent_dim = latent_dim
+        self.hidden_dim = hidden_dim
+        self.model = model
+        self.epoch = epoch
+        self.batch_sz = batch_sz if batch_sz else TUNED_PIPELINE_BATCH_SZ if tuned_pipeline else 1
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.tf_threads = tf_threads
+        self.cache_fp = cache_fp
+        self.eager = eager
+        self.tuned_pipeline = tuned_pipeline
+        self.latent_cols = ["state_m" + str(i) for i in range(latent_dim)] + \
+                           ["state_c" + str(i) for i in range(latent_dim)]
+
+        self.keys, self.values, self.offsets = trajectory_windows(data, self.groupby, feature_cols)
+        self.values_fp = data.values_fp if isinstance(data, WindowStore) else None
+        self.hashes = self.__content_hashes()
+        self.latent_state = pd.DataFrame()
+
+    def __content_hashes(self):
+        # The same windows trained with the same hyperparameters give the same latent state
+        settings = "{}_{}_{}_{}_{}_{}".format(self.model, self.latent_dim, self.hidden_dim, self.epoch, self.batch_sz,
+                                              self.tuned_pipeline).encode()
+        hashes = []
+        for lo, hi in zip(self.offsets[:-1], self.offsets[1:]):
+            h = hashlib.blake2b(settings, digest_size=16)
+            h.update(np.ascontiguousarray(self.values[lo:hi]).tobytes())
+            hashes.append(h.hexdigest())
+        return pd.Series(hashes, name=CONTENT_HASH_CN, dtype=object)
+
+    def __cache_load(self):
+        if self.cache_fp is None or not os.path.exists(self.cache_fp):
+            return pd.DataFrame(columns=[CONTENT_HASH_CN] + self.latent_cols)
+        cached = pd.read_csv(self.cache_fp, memory_map=True, dtype={CONTENT_HASH_CN: object})
+        cached = cached.drop_duplicates(subset=CONTENT_HASH_CN, keep="last")
+        log.i("Per-trajectory latent cache: {}/{} trajectories cached".format(
+            self.hashes.isin(cached[CONTENT_HASH_CN]).sum(), len(self.hashes.index)))
+        return cached
+
+    def __cache_append(self, task, states):
+        res = pd.concat([self.hashes.iloc[task].reset_index(drop=True),
+                         pd.DataFrame(states, columns=self.latent_cols)], axis=1)
+        if self.cache_fp is not None:
+            res.to_csv(self.cache_fp, mode="a", index=False, header=not os.path.exists(self.cache_fp))
+        return res
+
+    def train(self):
+        done = self.__cache_load()
+        # Identical trajectories are trained once
+        todo = np.flatnonzero(~self.hashes.isin(done[CONTENT_HASH_CN]) & ~self.hashes.duplicated())
+        tasks = [todo[lo:lo + TRAJECTORIES_PER_TASK] for lo in range(0, len(todo), TRAJECTORIES_PER_TASK)]
+        args = (self.latent_dim, self.hidden_dim, self.model, self.epoch, self.batch_sz, self.eager,
+                self.tuned_pipeline)
+
+        def bounds(task):
+            return [(self.offsets[i], self.offsets[i + 1]) for i in task]
+
+        executor, arrays_dir = None, None
+        if self.n_jobs is not None and self.n_jobs > 1:
+            # The workers read the window features from a memory map instead of receiving a copy
+            values_fp = self.values_fp
+            if values_fp is None:
+                arrays_dir = tempfile.TemporaryDirectory(prefix="deep_clustering_")
+                values_fp = os.path.join(arrays_dir.name, VALUES_FN)
+                np.save(values_fp, self.values)
+            # Spawned workers: the TensorFlow runtime of this process is not shared
+            executor = ProcessPoolExecutor(max_workers=self.n_jobs, mp_context=multiprocessing.get_context("spawn"),
+                                           initializer=_init_worker, initargs=(self.tf_threads,))
+            futures = [executor.submit(_train_trajectories, values_fp, bounds(task), *args) for task in tasks]
+            outputs = (future.result() for future in futures)
+        else:
+            outputs = (_train_trajectories(self.values, bounds(task), *args) for task in tasks)
+
+        results, trained = [done], 0
+        try:
+            for task, states in zip(tasks, outputs):
+                results.append(self.__cache_append(task, states))
+                trained += len(task)
+                if trained // PROGRESS_TRAJECTORIES != (trained - len(task)) // PROGRESS_TRAJECTORIES:
+                    log.i("Per-trajectory training: {}/{} trajectories".format(trained, len(todo)))
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            if arrays_dir is not None:
+                arrays_dir.cleanup()
+
+        # Latent states in trajectory order
+        res = pd.concat(results, axis=0, ignore_index=True).drop_duplicates(subset=CONTENT_HASH_CN, keep="last")
+        latent_state = self.hashes.to_frame().merge(res, on=CONTENT_HASH_CN, how="left")
+        latent_state = latent_state[self.latent_cols].astype(np.float32)
+        self.latent_state = pd.concat([self.keys.reset_index(drop=True), latent_state], axis=1)
+        return self
+
+    def get_latent_state(self):
+        return self.latent_state
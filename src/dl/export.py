@@ -0,0 +1,75 @@
+import os
+import json
+import tensorflow as tf
+
+from util.log import Log
+from serving.latent_encoder import SAVED_MODEL_DN, TFLITE_FN, META_FN, SIGNATURE
+
+log = Log(__name__, enable_console=True, enable_file=False)
+
+
+class EncoderModule(tf.Module):
+    """
+    Serving graph of a trained encoder: the LSTM cell steps over the windows in a symbolic loop that carries only the
+    states, so that the graph has dynamic batch and time dimensions and converts to TFLite builtin ops.
+    The masked windows keep the previous states, as the Keras masking of the training.
+    """
+    def __init__(self, encoder, feature_dim, name="encoder_module"):
+        super(EncoderModule, self).__init__(name=name)
+        self.cell = encoder.lstm.cell
+        self.units = encoder.enc_units
+        self.embed = tf.function(self.__embed, input_signature=[
+            tf.TensorSpec([None, None, feature_dim], tf.float32, name="x"),
+            tf.TensorSpec([None, None], tf.bool, name="mask")])
+
+    def __embed(self, x, mask):
+        zeros = tf.zeros([tf.shape(x)[0], self.units])
+
+        def step(t, state_m, state_c):
+            _, (new_m, new_c) = self.cell(x[:, t, :], [state_m, state_c], training=False)
+            valid = mask[:, t:t + 1]
+            return t + 1, tf.where(valid, new_m, state_m), tf.where(valid, new_c, state_c)
+
+        _, state_m, state_c = tf.while_loop(lambda t, state_m, state_c: t < tf.shape(x)[1], step,
+                                            (tf.constant(0), zeros, zeros))
+        return {"latent": tf.concat([state_m, state_c], axis=-1)}
+
+
+def export_encoder(ae, export_dir, tflite=True, quantize=True):
+    """
+    Export the encoder of a trained autoencoder for serving, loaded by serving.LatentEncoder.
+
+    Parameters
+    ----------
+    ae : AutoEncoder
+        trained autoencoder
+    export_dir : str
+        destination directory of the SavedModel, of the TFLite artifact and of the meta file
+    tflite : bool
+        True to convert the SavedModel to TFLite
+    quantize : bool
+        True for the TFLite dynamic range quantization of the weights
+
+    Returns
+    -------
+    str
+        export directory
+    """
+    log.d("Export encoder: {}".format(export_dir))
+    os.makedirs(export_dir, exist_ok=True)
+    module = EncoderModule(ae.encoder, ae.feature_dim)
+    saved_model_dir = os.path.join(export_dir, SAVED_MODEL_DN)
+    tf.saved_model.save(module, saved_model_dir, signatures={SIGNATURE: module.embed})
+
+    if tflite:
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir, signature_keys=[SIGNATURE])
+        if quantize:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        with open(os.path.join(export_dir, TFLITE_FN), "wb") as f:
+            f.write(converter.convert())
+
+    # The meta file is the last one: an export without meta is incomplete
+    with open(os.path.join(export_dir, META_FN), "w") as f:
+        json.dump({"feature_dim": ae.feature_dim, "latent_dim": ae.latent_dim, "model": ae.name,
+                   "tflite": tflite, "quantize": quantize}, f)
+    return export_dir
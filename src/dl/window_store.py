@@ -0,0 +1,165 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+from util.log import Log
+
+log = Log(__name__, enable_console=True, enable_file=False)
+
+VALUES_FN = "values.npy"
+LENGTHS_FN = "lengths.npy"
+KEYS_FN = "keys.csv"
+META_FN = "meta.json"
+
+
+def trajectory_windows(data, groupby, feature_cols):
+    """
+    Windows sorted by trajectory, keeping the window order inside each trajectory.
+
+    Parameters
+    ----------
+    data : DataFrame or WindowStore
+        windows with the groupby columns and the feature columns, or a loaded window store
+    groupby : list
+        columns that identify a trajectory
+    feature_cols : list
+        feature columns of the windows
+
+    Returns
+    -------
+    (DataFrame, ndarray, ndarray)
+        trajectory keys sorted as pandas groupby, float32 window features and trajectory start offsets
+    """
+    if isinstance(data, WindowStore):
+        return data.keys, data.values, data.offsets
+
+    group_ids = data.groupby(by=groupby, sort=True).ngroup().to_numpy()
+    order = np.argsort(group_ids, kind="stable")
+    first = np.flatnonzero(np.r_[True, group_ids[order][1:] != group_ids[order][:-1]]) \
+        if len(order) else np.empty(0, np.int64)
+    keys = data[groupby].iloc[order[first]].reset_index(drop=True)
+    values = data[feature_cols].iloc[order].to_numpy(dtype=np.float32)
+    return keys, values, np.r_[first, len(order)].astype(np.int64)
+
+
+def windows_fingerprint(data: pd.DataFrame, groupby, feature_cols):
+    """
+    Hash of the trajectory keys and of the window features, that identifies the content of a store.
+
+    Parameters
+    ----------
+    data : DataFrame
+        windows with the groupby columns and the feature columns
+    groupby : list
+        columns that identify a trajectory
+    feature_cols : list
+        feature columns of the windows
+
+    Returns
+    -------
+    str
+        hexadecimal digest
+    """
+    groupby = groupby if type(groupby) == list else [groupby]
+    h = hashlib.blake2b(",".join(groupby + list(feature_cols)).encode(), digest_size=16)
+    h.update(pd.util.hash_pandas_object(data[groupby + list(feature_cols)], index=False).to_numpy().tobytes())
+    return h.hexdigest()
+
+
+class WindowStore:
+    """
+    On-disk store of the window sequences of the trajectories, written once and memory mapped by the later runs.
+    The windows of all the trajectories are stored back to back in a float32 matrix with the length of each
+    trajectory and the trajectory keys, so that a trajectory is a slice of the memory map and the padded batches are
+    built only for the requested trajectories.
+
+    Parameters
+    ----------
+    store_dir : str
+        directory of the store files
+    """
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.values_fp = os.path.join(store_dir, VALUES_FN)
+        self.meta = {}
+        self.keys = pd.DataFrame()
+        self.values = np.empty((0, 0), dtype=np.float32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def exists(self, groupby=None, feature_cols=None, windows_num=None, fingerprint=None):
+        """
+        True if the store is written with the given settings and, if given, the windows_fingerprint of the windows.
+        """
+        meta_fp = os.path.join(self.store_dir, META_FN)
+        if not os.path.exists(meta_fp):
+            return False
+        with open(meta_fp, "r") as f:
+            meta = json.load(f)
+        settings = {"groupby": groupby, "feature_cols": feature_cols, "windows_num": windows_num,
+                    "fingerprint": fingerprint}
+        return all(v is None or meta.get(k) == v for k, v in settings.items())
+
+    def write(self, data: pd.DataFrame, groupby, feature_cols, fingerprint=None):
+        log.d("Window store write: {}".format(self.store_dir))
+        groupby = groupby if type(groupby) == list else [groupby]
+        fingerprint = windows_fingerprint(data, groupby, feature_cols) if fingerprint is None else fingerprint
+        keys, values, offsets = trajectory_windows(data, groupby, feature_cols)
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        np.save(self.values_fp, values)
+        np.save(os.path.join(self.store_dir, LENGTHS_FN), np.diff(offsets))
+        keys.to_csv(os.path.join(self.store_dir, KEYS_FN), index=False)
+        # The meta file is the last one: a store without meta is incomplete
+        with open(os.path.join(self.store_dir, META_FN), "w") as f:
+            json.dump({"groupby": groupby, "feature_cols": list(feature_cols), "windows_num": len(values),
+                       "fingerprint": fingerprint}, f)
+        return self.load()
+
+    def load(self):
+        if not self.exists():
+            log.e("{} window store not written: impossible to load".format(self.store_dir))
+            return self
+
+        with open(os.path.join(self.store_dir, META_FN), "r") as f:
+            self.meta = json.load(f)
+        self.values = np.load(self.values_fp, mmap_mode="r")
+        self.offsets = np.r_[0, np.cumsum(np.load(os.path.join(self.store_dir, LENGTHS_FN)))].astype(np.int64)
+        self.keys = pd.read_csv(os.path.join(self.store_dir, KEYS_FN), memory_map=True)
+        return self
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def sequence(self, i):
+        """
+        Windows of the i-th trajectory, as a view of the memory map.
+        """
+        return self.values[self.offsets[i]:self.offsets[i + 1]]
+
+    def padded(self, idx, width=None):
+        """
+        Padded batch of trajectories.
+
+        Parameters
+        ----------
+        idx : ndarray
+            trajectory indexes
+        width : int, optional
+            number of windows of the batch, default the longest trajectory of the batch; the longer trajectories
+            keep their last windows
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            (trajectories, width, features) windows padded at the beginning and (trajectories, width) valid mask
+        """
+        lengths = self.lengths()[idx]
+        width = int(lengths.max()) if width is None else width
+        lengths = np.minimum(lengths, width)
+        src = np.arange(width) - (width - lengths)[:, np.newaxis]
+        mask = src >= 0
+        x = np.asarray(self.values[np.where(mask, (self.offsets[idx + 1] - lengths)[:, np.newaxis] + src, 0)])
+        x[~mask] = 0
+        return x, mask
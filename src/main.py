@@ -77,10 +77,40 @@ def scooter_trajectories_test(config: configparser.SectionProxy, log_lvl):
         edgedelta=None if config["edgedelta"] is None else config.getfloat("edgedelta"),
         group_on_timedelta=config.getboolean("group-on-timedelta"),
         n_clusters=None if config["n-clusters"] is None else config.getint("n-clusters"),
+        kmeans_method=config["kmeans-method"],
+        ward_method=config["ward-method"],
+        mean_shift_method=config["mean-shift-method"],
+        auto_n_clusters=config.getboolean("auto-n-clusters"),
+        clustering_n_jobs=None if config["clustering-n-jobs"] is None else config.getint("clustering-n-jobs"),
+        clustering_warm_start=config.getboolean("clustering-warm-start"),
+        clustering_preprocessing_cache=config.getboolean("clustering-preprocessing-cache"),
+        clustering_sample_size=None if config["clustering-sample-size"] is None else config.getint(
+            "clustering-sample-size"),
+        density_method=config["density-method"],
+        dbscan_eps=None if config["dbscan-eps"] is None else config.getfloat("dbscan-eps"),
+        grid_cell_size=None if config["grid-cell-size"] is None else config.getfloat("grid-cell-size"),
+        silhouette_sample_size=None if config["silhouette-sample-size"] is None else config.getint(
+            "silhouette-sample-size"),
         with_pca=config.getboolean("with-pca"),
         with_standardization=config.getboolean("with-standardization"),
         with_normalization=config.getboolean("with-normalization"),
         only_north=config.getboolean("only-north"),
+        moving_behavior_n_jobs=None if config["moving-behavior-n-jobs"] is None else config.getint(
+            "moving-behavior-n-jobs"),
+        moving_behavior_stream=config.getboolean("moving-behavior-stream"),
+        moving_behavior_time_window=config.getboolean("moving-behavior-time-window"),
+        sliding_window_width=config["sliding-window-width"],
+        sliding_window_offset=config["sliding-window-offset"],
+        moving_behavior_features_cols=None if config["moving-behavior-features"] is None else [
+            cn.strip() for cn in config["moving-behavior-features"].split(",")],
+        dl_global=config.getboolean("dl-global-training"),
+        dl_eager=config.getboolean("dl-eager"),
+        dl_n_jobs=None if config["dl-n-jobs"] is None else config.getint("dl-n-jobs"),
+        dl_max_windows=None if config["dl-max-windows"] is None else config.getint("dl-max-windows"),
+        dl_tuned_pipeline=config.getboolean("dl-tuned-pipeline"),
+        dl_batch_size=None if config["dl-batch-size"] is None else config.getint("dl-batch-size"),
+        dl_multi_decoder=config.getboolean("dl-multi-decoder"),
+        dl_export=config.getboolean("dl-export"),
         epoch=config.getint("epoch"),
         latent_dim=config.getint("latent-dim"),
         dl_config=config["decoder-type"],
@@ -123,6 +153,7 @@ def scooter_trajectories_test(config: configparser.SectionProxy, log_lvl):
         st_test.heuristic_data_analysis()
 
     if config.getboolean("perform-clustering") and st_test.is_clustering_processed():
+        st_test.clustering_evaluation()
         st_test.clusterized_data_analysis()
         st_test.cluster_maps()
         st_test.cluster_maps_3d()
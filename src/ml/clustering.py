@@ -1,16 +1,21 @@
 import time
 import sys
 import os
+import hashlib
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from scipy.cluster.hierarchy import dendrogram
 from sklearn.preprocessing import StandardScaler, Normalizer
-from sklearn.cluster import KMeans, MeanShift, estimate_bandwidth, AgglomerativeClustering
+from sklearn.cluster import KMeans, MiniBatchKMeans, MeanShift, estimate_bandwidth, AgglomerativeClustering, Birch, \
+    DBSCAN, get_bin_seeds
 from sklearn.mixture import GaussianMixture
 from sklearn.decomposition import PCA
-from sklearn.metrics import silhouette_score
+from sklearn.metrics import pairwise_distances_chunked
+from sklearn.neighbors import KNeighborsClassifier, KDTree
 
 from util.util import get_elapsed
 from util.log import Log
@@ -20,27 +25,121 @@ from util.constant import IMAGE_FOLDER
 log = Log(__name__, enable_console=True, enable_file=False)
 
 CLUSTER_ID = "c_id"
+# Mini-batch k-means: samples of each batch, and samples of each chunk of the streaming k-means
+MINIBATCH_SIZE = 4096
+STREAM_CHUNK_SIZE = 65536
+# Streaming k-means: maximum passes over the chunks and center shift of a pass that stops them, relative to the
+# mean variance of the features
+STREAM_MAX_PASSES = 10
+STREAM_TOL = 1e-4
+KMEANS_METHODS = ["k-means", "minibatch-k-means", "streaming-k-means"]
+TEST_RESULTS_COLS = ["n_clusters", "wcss", "bic", "elapsed"]
+# Warm-started sweep: candidates of the k-means++ step that adds a center to the previous ones
+WARM_START_TRIALS = 8
+# Automatic number of clusters: fits that confirm the selection and maximum relative WCSS decrease of those fits
+SELECTION_PATIENCE = 3
+SELECTION_TOL = 0.05
+# Selections shared by the Clustering instances of the same data, least recently used first
+SELECTION_CACHE_SIZE = 16
+_selection_cache = OrderedDict()
+# BIRCH subcluster radius, relative to the total standard deviation of the data, maximum subclusters of the ward
+# linkage, quadratic in memory, and samples of each chunk of the CF tree
+BIRCH_THRESHOLD = 0.1
+BIRCH_MAX_SUBCLUSTERS = 4096
+BIRCH_CHUNK_SIZE = 16384
+# Density methods: neighbourhood radius, grid cell side and minimum samples of a core point, in the preprocessed space
+DBSCAN_EPS = 0.05
+GRID_CELL_SIZE = 0.05
+DBSCAN_MIN_SAMPLES = 10
+DENSITY_METHODS = ["grid-dbscan", "dbscan", "hdbscan"]
+# Tree mean-shift: samples of the bandwidth estimate, iterations of a seed and shift of a converged seed (bandwidths)
+MEAN_SHIFT_BANDWIDTH_SAMPLES = 2000
+MEAN_SHIFT_MAX_ITER = 300
+MEAN_SHIFT_TOL = 1e-3
+# Fit on sample: samples assigned at once and neighbours of the label vote of the methods without predict
+ASSIGN_BATCH_SIZE = 65536
+ASSIGN_NEIGHBORS = 5
+# Preprocessed data shared by the Clustering instances of the same data, least recently used first
+PREPROCESSING_CACHE_SIZE = 16
+_preprocessing_cache = OrderedDict()
+# Evaluation: silhouette samples (None for the exact score), memory of a block of pairwise distances (MiB) and
+# scores kept for each labelling, least recently used first
+SILHOUETTE_SAMPLE_SIZE = 20000
+EVALUATION_WORKING_MEMORY = 256
+EVALUATION_COLS = ["silhouette", "davies_bouldin", "calinski_harabasz"]
+EVALUATION_CACHE_SIZE = 64
+_evaluation_cache = OrderedDict()
 
 
 class Clustering:
-    def __init__(self, data, feature_names, dataset_name=None, save_file=False):
+    def __init__(self, data, feature_names, dataset_name=None, save_file=False, preprocessing_cache_dir=None,
+                 strata=None):
         self.feature_names = feature_names
         self.x = pd.DataFrame(np.c_[data[feature_names]], columns=feature_names)
+        # Stratum of each sample for the fit on sample, e.g. the rental
+        self.strata = None if strata is None else \
+            data.groupby(by=strata if type(strata) == list else [strata], sort=False).ngroup().to_numpy()
         self.dataset_name = "" if dataset_name is None else dataset_name
         self.save_file = save_file
         self.wcss = None
+        self.test_results = None
+        self.n_clusters = None
+        # Fit of the selected number of clusters: ((method, n_clusters, preprocessing settings), (inertia, labels,
+        # model)), reused by exec
+        self.selection_fit = None
         self.inertia = None
         self.labels = None
         self.model = None
         self.method = None
         self.x_preprocessed = None
+        self.preprocessing_settings = None
+        self.preprocessing_cache_dir = preprocessing_cache_dir
+        self.fingerprint = None
 
         self.image_folder = os.path.join(IMAGE_FOLDER, dataset_name) if dataset_name is not None else IMAGE_FOLDER
         if not os.path.exists(self.image_folder) and self.save_file:
             os.makedirs(self.image_folder)
 
+    def __get_fingerprint(self):
+        # Hash of the data and of the feature names, computed once
+        if self.fingerprint is None:
+            h = hashlib.blake2b(",".join(map(str, self.x.columns)).encode(), digest_size=16)
+            h.update(np.ascontiguousarray(self.x.to_numpy()).tobytes())
+            self.fingerprint = h.hexdigest()
+        return self.fingerprint
+
+    def __memoized(self, settings, fn, persist=False):
+        # In memory LRU cache keyed by the data fingerprint and the settings, optionally persisted as npy file
+        key = hashlib.blake2b("{}_{}".format(self.__get_fingerprint(), settings).encode(), digest_size=16).hexdigest()
+        if key in _preprocessing_cache:
+            _preprocessing_cache.move_to_end(key)
+            return _preprocessing_cache[key]
+
+        fp = None if self.preprocessing_cache_dir is None or not persist else \
+            os.path.join(self.preprocessing_cache_dir, key + ".npy")
+        if fp is not None and os.path.exists(fp):
+            value = np.load(fp)
+        else:
+            value = fn()
+            if fp is not None:
+                os.makedirs(self.preprocessing_cache_dir, exist_ok=True)
+                np.save(fp, value)
+        # Shared by the instances: read only
+        value.setflags(write=False)
+        _preprocessing_cache[key] = value
+        if len(_preprocessing_cache) > PREPROCESSING_CACHE_SIZE:
+            _preprocessing_cache.popitem(last=False)
+        return value
+
     def __preprocessing(self, x, standardize=False, normalize=False, pca=False, components=None):
         start = time.time()
+        settings = (standardize, normalize, pca, components)
+        x = self.__memoized(settings, lambda: self.__fit_preprocessing(x, standardize, normalize, pca, components),
+                            persist=True)
+        end = time.time()
+        return x, get_elapsed(start, end)
+
+    def __fit_preprocessing(self, x, standardize=False, normalize=False, pca=False, components=None):
         columns = x.columns
         x = x.to_numpy()
         if standardize:
@@ -74,48 +173,10 @@ class Clustering:
                 n_components = np.where(variance_cumulated > 0.8)[0][0]
                 pca_model = PCA(n_components=max(n_components, 1))
                 x = pca_model.fit_transform(x)
+        return x
 
-        end = time.time()
-        return x, get_elapsed(start, end)
-
-    def __exec(self, x, method, n_clusters):
-        start = time.time()
-        if method == "k-means":
-            km = KMeans(n_clusters=n_clusters, init="k-means++", random_state=42)
-            km.fit(x)
-            inertia = km.inertia_
-            labels = km.labels_
-            model = km
-        elif method == "mean-shift":
-            bandwidth = estimate_bandwidth(x, quantile=0.2, n_samples=500)
-            ms = MeanShift(bandwidth=bandwidth, bin_seeding=True)
-            ms.fit(x)
-            inertia = None
-            labels = ms.labels_
-            model = ms
-        elif method == "gaussian-mixture":
-            mg = GaussianMixture(n_components=n_clusters)
-            mg.fit(x)
-            inertia = None
-            labels = mg.predict(x)
-            model = mg
-        elif method == "full-agglomerative":
-            fa = AgglomerativeClustering(linkage="complete", n_clusters=n_clusters, compute_distances=True)
-            fa.fit(x)
-            inertia = None
-            labels = fa.labels_
-            model = fa
-        elif method == "ward-agglomerative":
-            fa = AgglomerativeClustering(linkage="ward", n_clusters=n_clusters, compute_distances=True)
-            fa.fit(x)
-            inertia = None
-            labels = fa.labels_
-            model = fa
-        else:
-            log.e("Clustering __exec: method {} not recognised".format(method))
-            return None, None, 0
-        end = time.time()
-        return inertia, labels, model, get_elapsed(start, end)
+    def __exec(self, x, method, n_clusters, eps=None, cell_size=None, n_jobs=None):
+        return _exec(x, method, n_clusters, eps=eps, cell_size=cell_size, n_jobs=n_jobs)
 
     def __get_cumulated_variance(self, x):
         scaler = StandardScaler()
@@ -125,16 +186,55 @@ class Clustering:
         variance_cumulated = pca_model.explained_variance_ratio_.cumsum()
         return variance_cumulated
 
-    def exec(self, method, n_clusters, standardize=False, normalize=False, pca=False, components=None):
+    def exec(self, method, n_clusters, standardize=False, normalize=False, pca=False, components=None,
+             sample_size=None, assign="auto", eps=None, cell_size=None, n_jobs=None):
+        """
+        Clustering of the data.
+
+        Parameters
+        ----------
+        sample_size : int, optional
+            fit the method on a sample of sample_size samples, stratified by the strata given to the
+            constructor, then assign all the samples; None to fit on all the samples
+        assign : str
+            assignment of the samples out of the sample: "predict" by the fitted model, "centroid" to the nearest
+            cluster centroid, "knn" by label vote of the nearest sampled neighbours, "auto" for predict if the model
+            has it, knn otherwise
+        eps : float, optional
+            neighbourhood radius of dbscan in the preprocessed space, default DBSCAN_EPS
+        cell_size : float, optional
+            cell side of grid-dbscan in the preprocessed space, default GRID_CELL_SIZE
+        n_jobs : int, optional
+            worker processes of tree-mean-shift; None or 1 for the current process, -1 for all CPUs
+        """
         log.d("Clustering {} preprocessing".format(self.dataset_name))
         x, elapsed = self.__preprocessing(self.x, standardize=standardize, normalize=normalize,
                                           pca=pca, components=components)
         self.x_preprocessed = pd.DataFrame(x)
+        self.preprocessing_settings = (standardize, normalize, pca, components)
         log.d("elapsed time: {}".format(elapsed))
         log.d("components: {}".format(x.shape[1]))
 
-        log.d("Clustering {} exec {}".format(self.dataset_name, method))
-        inertia, labels, model, elapsed = self.__exec(x, method, n_clusters)
+        sampled = sample_size is not None and sample_size < x.shape[0]
+        if not sampled and self.selection_fit is not None and \
+                self.selection_fit[0] == (method, n_clusters, self.preprocessing_settings):
+            log.d("Clustering {} exec {}: fit of the number of clusters selection".format(self.dataset_name, method))
+            inertia, labels, model = self.selection_fit[1]
+            elapsed = get_elapsed(0, 0)
+        elif sampled:
+            log.d("Clustering {} exec {} on a sample of {}".format(self.dataset_name, method, sample_size))
+            start = time.time()
+            idx = _stratified_sample(self.strata, x.shape[0], sample_size)
+            inertia, labels, model, _ = self.__exec(x[idx], method, n_clusters, eps=eps, cell_size=cell_size,
+                                                    n_jobs=n_jobs)
+            if labels is not None:
+                labels = _assign(x, idx, labels, model, assign)
+                inertia = None if inertia is None else -_batched(x, model.score, sum)
+            elapsed = get_elapsed(start, time.time())
+        else:
+            log.d("Clustering {} exec {}".format(self.dataset_name, method))
+            inertia, labels, model, elapsed = self.__exec(x, method, n_clusters, eps=eps, cell_size=cell_size,
+                                                          n_jobs=n_jobs)
         log.d("elapsed time: {}".format(elapsed))
 
         self.method = method
@@ -143,34 +243,121 @@ class Clustering:
         self.model = model
         return self
 
-    def test(self, method, range_clusters=range(1, 50), standardize=False, normalize=False, pca=False, components=None):
+    def test(self, method, range_clusters=range(1, 50), standardize=False, normalize=False, pca=False, components=None,
+             n_jobs=None, warm_start=False):
+        """
+        Elbow sweep: a model for each number of clusters in range_clusters.
+
+        Parameters
+        ----------
+        n_jobs : int, optional
+            number of worker processes, each one fits a contiguous block of the range; None or 1 for the current
+            process, -1 for all CPUs
+        warm_start : bool
+            True to initialize each k-means fit with the centers of the previous number of clusters of the same block
+            plus a seeded k-means++ center
+        """
         log.d("Clustering {} preprocessing".format(self.dataset_name))
         x, elapsed = self.__preprocessing(self.x, standardize=standardize, normalize=normalize,
                                           pca=pca, components=components)
         log.d("elapsed time: {}".format(elapsed))
         log.d("components: {}".format(x.shape[1]))
 
-        log.d("Clustering {} k-means test in range {}".format(self.dataset_name, range_clusters))
+        log.d("Clustering {} {} test in range {}".format(self.dataset_name, method, range_clusters))
         start = time.time()
-        wcss = []
-        for c in range_clusters:
-            inertia, _, _, _ = self.__exec(x, method, c)
-            wcss.append(inertia)
-            sys.stdout.write("\r {:.3f} %".format(c * 100 / range_clusters.stop))
+        n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        n_clusters_list = list(range_clusters)
+        if n_jobs is not None and n_jobs > 1:
+            blocks = [b.tolist() for b in np.array_split(n_clusters_list, min(n_jobs, len(n_clusters_list)))]
+            with ProcessPoolExecutor(max_workers=len(blocks)) as executor:
+                futures = [executor.submit(_sweep_block, x, method, block, warm_start) for block in blocks]
+                res = []
+                for future in as_completed(futures):
+                    res += future.result()
+                    sys.stdout.write("\r {:.3f} %".format(len(res) * 100 / len(n_clusters_list)))
+        else:
+            res = []
+            for fit in _sweep(x, method, n_clusters_list, warm_start):
+                res.append(fit)
+                sys.stdout.write("\r {:.3f} %".format(len(res) * 100 / len(n_clusters_list)))
 
         sys.stdout.write("\r")
         end = time.time()
         log.d("elapsed time: {}".format(get_elapsed(start, end)))
 
-        self.wcss = wcss
+        self.test_results = pd.DataFrame(res, columns=TEST_RESULTS_COLS).sort_values("n_clusters")
+        self.wcss = self.test_results["wcss"].tolist()
         return self
 
+    def select_n_clusters(self, method, range_clusters=range(1, 30), standardize=False, normalize=False, pca=False,
+                          components=None, warm_start=False, patience=SELECTION_PATIENCE, tol=SELECTION_TOL):
+        """
+        Automatic number of clusters, with a sweep over range_clusters that stops once the selection is confirmed.
+        The k-means and the other WCSS methods select the knee of the WCSS curve, confirmed when it is unchanged
+        for patience fits that decrease the WCSS by less than tol; the gaussian mixture selects the minimum BIC,
+        confirmed when it does not improve for patience fits.
+        The selection is in n_clusters, the fits done in test_results and the fit of the selected number of clusters
+        in selection_fit, reused by exec with the same method and preprocessing. The selections are cached for each
+        data, preprocessing and settings, so that the sweep is done once.
+        """
+        log.d("Clustering {} preprocessing".format(self.dataset_name))
+        x, elapsed = self.__preprocessing(self.x, standardize=standardize, normalize=normalize,
+                                          pca=pca, components=components)
+        log.d("elapsed time: {}".format(elapsed))
+
+        settings = (standardize, normalize, pca, components)
+        key = hashlib.blake2b("{}_{}_{}_{}_{}_{}_{}".format(self.__get_fingerprint(), settings, method,
+                                                            list(range_clusters), warm_start, patience, tol).encode(),
+                              digest_size=16).hexdigest()
+        if key not in _selection_cache:
+            _selection_cache[key] = self.__select_n_clusters(x, method, range_clusters, warm_start, patience, tol)
+            if len(_selection_cache) > SELECTION_CACHE_SIZE:
+                _selection_cache.popitem(last=False)
+        _selection_cache.move_to_end(key)
+        selected, test_results, fit = _selection_cache[key]
+        if test_results is None:
+            return self
+
+        self.test_results = test_results.copy()
+        self.wcss = self.test_results["wcss"].tolist()
+        self.n_clusters = selected
+        self.selection_fit = None if fit is None else ((method, selected, settings), fit)
+        return self
+
+    def __select_n_clusters(self, x, method, range_clusters, warm_start, patience, tol):
+        log.d("Clustering {} {} number of clusters selection in range {}".format(self.dataset_name, method,
+                                                                                 range_clusters))
+        start = time.time()
+        res, fits, selected, confirmed = [], {}, None, 0
+        for fit in _sweep(x, method, list(range_clusters), warm_start, fits=fits):
+            res.append(fit)
+            results = pd.DataFrame(res, columns=TEST_RESULTS_COLS)
+            if fit[2] is not None:
+                candidate = int(results.loc[results["bic"].idxmin(), "n_clusters"])
+                confirmed = confirmed + 1 if candidate == selected else 0
+            elif fit[1] is not None:
+                candidate = _knee(results["n_clusters"], results["wcss"])
+                wcss = results["wcss"].to_numpy()
+                flat = len(wcss) > 1 and wcss[-2] - wcss[-1] < tol * wcss[-2]
+                confirmed = confirmed + 1 if candidate is not None and candidate == selected and flat else 0
+            else:
+                log.e("Clustering select_n_clusters: method {} has neither WCSS nor BIC".format(method))
+                return None, None, None
+            selected = candidate
+            if confirmed >= patience:
+                break
+        end = time.time()
+        log.d("elapsed time: {}".format(get_elapsed(start, end)))
+        log.i("Clustering {} {}: {} clusters selected after {} fits".format(self.dataset_name, method, selected,
+                                                                            len(res)))
+        return selected, pd.DataFrame(res, columns=TEST_RESULTS_COLS), fits.get(selected)
+
     def show_variance(self, title="Explained Variance by Components", save_file=False, prefix=None):
         prefix = "" if prefix is None else "{}_".format(prefix)
         filename = prefix + "variance.png"
         log.d("Clustering {} show cumulative variance".format(self.dataset_name))
         start = time.time()
-        variance_cumulated = self.__get_cumulated_variance(self.x)
+        variance_cumulated = self.__memoized("variance", lambda: self.__get_cumulated_variance(self.x))
 
         plt.figure(figsize=(10, 8))
         plt.plot(range(1, variance_cumulated.shape[0] + 1), variance_cumulated, marker="o", linestyle="--")
@@ -196,7 +383,7 @@ class Clustering:
 
         start = time.time()
         plt.figure(figsize=(10, 8))
-        plt.plot(range(1, len(self.wcss) + 1), self.wcss, marker="o", linestyle="--")
+        plt.plot(self.test_results["n_clusters"], self.wcss, marker="o", linestyle="--")
         plt.title(title)
         plt.xlabel("Number of Clusters")
         plt.ylabel("WCSS")
@@ -210,10 +397,11 @@ class Clustering:
         return self
 
     def show_dendrogram(self, title="Hierarchical Dendrogram", save_file=False, prefix=None):
-        model = self.model
+        # BIRCH: the hierarchy is over the subclusters, each one is a leaf
+        model = self.model.n_clusters if isinstance(self.model, Birch) else self.model
         method = self.method
         log.d("Clustering {} plot dendrogram".format(self.dataset_name))
-        if (model is None) or ((method != "ward-agglomerative") and (method != "full-agglomerative")):
+        if (model is None) or (not method.endswith("agglomerative")):
             log.e("Clustering error: method performed not compliant with dendrogram, perform an hierarchical method")
             return self
 
@@ -246,14 +434,45 @@ class Clustering:
         log.d("elapsed time: {}".format(get_elapsed(start, end)))
         return self
 
-    def silhouette(self):
+    def evaluate(self, sample_size=SILHOUETTE_SAMPLE_SIZE):
+        """
+        Quality scores of the labelling in the preprocessed space: silhouette, Davies-Bouldin and Calinski-Harabasz.
+        The scores are cached for each data, preprocessing and labelling, so that they are computed once.
+
+        Parameters
+        ----------
+        sample_size : int, optional
+            samples of the silhouette, None for the exact score over all the samples
+
+        Returns
+        -------
+        dict
+            score of each column of EVALUATION_COLS, NaN if the labelling has less than 2 clusters
+        """
         if (self.labels is None) or (self.x_preprocessed is None):
-            log.e("Clustering error: labels None, perform exec before silhouette score")
+            log.e("Clustering error: labels None, perform exec before evaluate")
             return None
 
-        return silhouette_score(self.x_preprocessed, self.labels, sample_size=20000)
-
-    def stats(self):
+        labels = np.asarray(self.labels)
+        h = hashlib.blake2b("{}_{}_{}".format(self.__get_fingerprint(), self.preprocessing_settings,
+                                              sample_size).encode(), digest_size=16)
+        h.update(np.ascontiguousarray(labels).tobytes())
+        key = h.hexdigest()
+        if key not in _evaluation_cache:
+            log.d("Clustering {} evaluate {}".format(self.dataset_name, self.method))
+            start = time.time()
+            _evaluation_cache[key] = _evaluate(self.x_preprocessed.to_numpy(), labels, sample_size=sample_size)
+            log.d("elapsed time: {}".format(get_elapsed(start, time.time())))
+            if len(_evaluation_cache) > EVALUATION_CACHE_SIZE:
+                _evaluation_cache.popitem(last=False)
+        _evaluation_cache.move_to_end(key)
+        return dict(_evaluation_cache[key])
+
+    def silhouette(self, sample_size=SILHOUETTE_SAMPLE_SIZE):
+        scores = self.evaluate(sample_size=sample_size)
+        return None if scores is None else scores["silhouette"]
+
+    def stats(self, sample_size=SILHOUETTE_SAMPLE_SIZE):
         log.d("Clustering {} stats".format(self.dataset_name))
         if (self.labels is None) or (self.method is None):
             log.e("Clustering error: impossible to print stats if not exec earlier")
@@ -263,10 +482,417 @@ class Clustering:
         x[CLUSTER_ID] = self.labels
 
         group = x.groupby(by=CLUSTER_ID)
+        scores = self.evaluate(sample_size=sample_size)
         log.i("***************************** Clustering - Method {:23} ***************************".format(self.method))
         log.i("[FEATURES MEAN]: \n{}".format(group.mean()))
         log.i("[FEATURES STD]: \n{}".format(group.std()))
-        log.i("[SILHOUETTE SCORE]: {}".format(self.silhouette()))
+        log.i("[SILHOUETTE SCORE]: {}".format(scores["silhouette"]))
+        log.i("[DAVIES-BOULDIN SCORE]: {}".format(scores["davies_bouldin"]))
+        log.i("[CALINSKI-HARABASZ SCORE]: {}".format(scores["calinski_harabasz"]))
         log.i("*******************************************************************************************************")
 
         return self
+
+
+def _evaluate(x, labels, sample_size=SILHOUETTE_SAMPLE_SIZE, working_memory=EVALUATION_WORKING_MEMORY,
+              random_state=42):
+    """
+    Silhouette, Davies-Bouldin and Calinski-Harabasz scores in a single pass over the data. The noise of the density
+    methods (label -1) is not a cluster and is left out.
+    The centroids and the distance of each sample from its centroid are shared by Davies-Bouldin and
+    Calinski-Harabasz; the silhouette reduces each block of pairwise distances to the per cluster sums, so that the
+    memory is bounded by working_memory also for the exact score.
+    """
+    scores = dict.fromkeys(EVALUATION_COLS, np.nan)
+    keep = labels != -1
+    x, labels = x[keep], labels[keep]
+    _, labels = np.unique(labels, return_inverse=True)
+    n_samples, n_clusters = len(labels), labels.max() + 1 if len(labels) else 0
+    if n_clusters < 2 or n_clusters >= n_samples:
+        return scores
+
+    counts = np.bincount(labels, minlength=n_clusters)
+    centroids = np.zeros((n_clusters, x.shape[1]))
+    np.add.at(centroids, labels, x)
+    centroids /= counts[:, np.newaxis]
+    dist = _batched(np.arange(n_samples), lambda i: np.linalg.norm(x[i] - centroids[labels[i]], axis=1))
+
+    # Calinski-Harabasz: between over within cluster dispersion
+    between = np.sum(counts * np.sum((centroids - x.mean(axis=0)) ** 2, axis=1))
+    within = np.sum(dist ** 2)
+    scores["calinski_harabasz"] = 1. if within == 0 else \
+        between * (n_samples - n_clusters) / (within * (n_clusters - 1))
+
+    # Davies-Bouldin: mean over the clusters of the worst ratio of the scatters to the centroid distance
+    scatter = np.bincount(labels, weights=dist, minlength=n_clusters) / counts
+    centroid_dist = np.linalg.norm(centroids[:, np.newaxis] - centroids[np.newaxis], axis=-1)
+    centroid_dist[centroid_dist == 0] = np.inf
+    scores["davies_bouldin"] = np.mean(np.max((scatter[:, np.newaxis] + scatter[np.newaxis]) / centroid_dist, axis=1))
+
+    # Silhouette on a sample, or on all the samples
+    if sample_size is not None and sample_size < n_samples:
+        idx = np.random.default_rng(random_state).choice(n_samples, sample_size, replace=False)
+        x, labels = x[idx], labels[idx]
+        counts = np.bincount(labels, minlength=n_clusters)
+    one_hot = np.zeros((len(labels), n_clusters))
+    one_hot[np.arange(len(labels)), labels] = 1
+    sums = np.concatenate(list(pairwise_distances_chunked(x, reduce_func=lambda d, _: d @ one_hot,
+                                                          working_memory=working_memory)))
+    own = sums[np.arange(len(labels)), labels]
+    a = own / np.maximum(counts[labels] - 1, 1)
+    # Nearest other cluster, among the clusters in the sample
+    sums[np.arange(len(labels)), labels] = np.inf
+    sums[:, counts == 0] = np.inf
+    b = np.min(sums / np.maximum(counts, 1), axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        s = np.nan_to_num((b - a) / np.maximum(a, b))
+    # The samples alone in their cluster have silhouette 0
+    s[counts[labels] == 1] = 0
+    scores["silhouette"] = np.mean(s)
+    return scores
+
+
+def _streaming_kmeans(x, n_clusters, init="k-means++", chunk_size=STREAM_CHUNK_SIZE, max_passes=STREAM_MAX_PASSES,
+                      tol=STREAM_TOL):
+    # The model is updated chunk by chunk, then the labels and the inertia are taken chunk by chunk
+    # Chunks of at least chunk_size samples, the first chunk initializes the centers with the best of several seeds
+    bounds = np.linspace(0, x.shape[0], max(x.shape[0] // chunk_size, 1) + 1).astype(np.int64)
+    if not isinstance(init, np.ndarray):
+        init = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=3, batch_size=MINIBATCH_SIZE,
+                               random_state=42).fit(x[bounds[0]:bounds[1]]).cluster_centers_
+    km = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=1, batch_size=MINIBATCH_SIZE, random_state=42)
+    rng = np.random.default_rng(42)
+    variance = None
+    for _ in range(max_passes):
+        centers = km.cluster_centers_.copy() if hasattr(km, "cluster_centers_") else None
+        moments = np.zeros((3, x.shape[1]))
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            # Each chunk is shuffled and fed in mini-batches, a mini-batch step for each
+            chunk = x[lo:hi][rng.permutation(hi - lo)]
+            for b in range(0, len(chunk), MINIBATCH_SIZE):
+                km.partial_fit(chunk[b:b + MINIBATCH_SIZE])
+            if variance is None:
+                moments += [np.full(x.shape[1], len(chunk)), chunk.sum(axis=0), (chunk ** 2).sum(axis=0)]
+        if variance is None:
+            variance = np.mean(moments[2] / moments[0] - (moments[1] / moments[0]) ** 2)
+        # Stop when a pass moves the centers less than the tolerance
+        if centers is not None and np.sum((km.cluster_centers_ - centers) ** 2) <= tol * variance:
+            break
+    labels = np.empty(x.shape[0], dtype=np.int32)
+    inertia = 0.
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        labels[lo:hi] = km.predict(x[lo:hi])
+        inertia -= km.score(x[lo:hi])
+    return km, inertia, labels
+
+
+def _exec(x, method, n_clusters, init="k-means++", eps=None, cell_size=None, n_jobs=None):
+    # init: initial centers of the k-means methods, an array to warm start from the centers of a previous fit
+    # eps, cell_size: radius of dbscan and cell side of grid-dbscan, None for the defaults
+    # n_jobs: worker processes of tree-mean-shift
+    start = time.time()
+    if method == "k-means":
+        km = KMeans(n_clusters=n_clusters, init=init, n_init=1 if isinstance(init, np.ndarray) else 10,
+                    random_state=42)
+        km.fit(x)
+        inertia = km.inertia_
+        labels = km.labels_
+        model = km
+    elif method == "minibatch-k-means":
+        km = MiniBatchKMeans(n_clusters=n_clusters, init=init, n_init=1, batch_size=MINIBATCH_SIZE, random_state=42)
+        km.fit(x)
+        inertia = km.inertia_
+        labels = km.labels_
+        model = km
+    elif method == "streaming-k-means":
+        km, inertia, labels = _streaming_kmeans(x, n_clusters, init=init)
+        model = km
+    elif method == "mean-shift":
+        bandwidth = estimate_bandwidth(x, quantile=0.2, n_samples=500)
+        ms = MeanShift(bandwidth=bandwidth, bin_seeding=True)
+        ms.fit(x)
+        inertia = None
+        labels = ms.labels_
+        model = ms
+    elif method == "tree-mean-shift":
+        ms = _TreeMeanShift(n_jobs=n_jobs)
+        ms.fit(x)
+        inertia = None
+        labels = ms.labels_
+        model = ms
+    elif method == "gaussian-mixture":
+        mg = GaussianMixture(n_components=n_clusters)
+        mg.fit(x)
+        inertia = None
+        labels = mg.predict(x)
+        model = mg
+    elif method == "full-agglomerative":
+        fa = AgglomerativeClustering(linkage="complete", n_clusters=n_clusters, compute_distances=True)
+        fa.fit(x)
+        inertia = None
+        labels = fa.labels_
+        model = fa
+    elif method == "ward-agglomerative":
+        fa = AgglomerativeClustering(linkage="ward", n_clusters=n_clusters, compute_distances=True)
+        fa.fit(x)
+        inertia = None
+        labels = fa.labels_
+        model = fa
+    elif method == "birch-ward-agglomerative":
+        # CF-tree pre-aggregation in bounded memory, then ward linkage over the subcluster centers
+        fa = AgglomerativeClustering(linkage="ward", n_clusters=n_clusters, compute_distances=True)
+        bi = _capped_birch(x, fa)
+        inertia = None
+        labels = bi.predict(x)
+        model = bi
+    elif method == "grid-dbscan":
+        gd = _GridDBSCAN(GRID_CELL_SIZE if cell_size is None else cell_size)
+        gd.fit(x)
+        inertia = None
+        labels = gd.labels_
+        model = gd
+    elif method == "dbscan":
+        db = DBSCAN(eps=DBSCAN_EPS if eps is None else eps, min_samples=DBSCAN_MIN_SAMPLES, algorithm="kd_tree")
+        db.fit(x)
+        inertia = None
+        labels = db.labels_
+        model = db
+    elif method == "hdbscan":
+        # HDBSCAN is in scikit-learn >= 1.3 only, the other methods run with the pinned scikit-learn
+        try:
+            from sklearn.cluster import HDBSCAN
+        except ImportError:
+            log.e("Clustering __exec: method hdbscan requires scikit-learn >= 1.3")
+            return None, None, None, 0
+        hd = HDBSCAN(min_cluster_size=DBSCAN_MIN_SAMPLES, algorithm="kd_tree", copy=True)
+        hd.fit(x)
+        inertia = None
+        labels = hd.labels_
+        model = hd
+    else:
+        log.e("Clustering __exec: method {} not recognised".format(method))
+        return None, None, None, 0
+    end = time.time()
+    return inertia, labels, model, get_elapsed(start, end)
+
+
+def _capped_birch(x, n_clusters, max_subclusters=BIRCH_MAX_SUBCLUSTERS, chunk_size=BIRCH_CHUNK_SIZE):
+    # CF tree built chunk by chunk: when the subclusters exceed max_subclusters the threshold is raised and the tree
+    # is rebuilt from the subcluster centers, then the global clustering runs over at most max_subclusters centers
+    threshold = BIRCH_THRESHOLD * np.sqrt(x.var(axis=0).sum())
+    bi = Birch(threshold=threshold, n_clusters=None)
+    for lo in range(0, x.shape[0], chunk_size):
+        bi.partial_fit(x[lo:lo + chunk_size])
+        while len(bi.subcluster_centers_) > max_subclusters:
+            # The subclusters of a density in d dimensions scale as threshold^-d
+            threshold *= max((len(bi.subcluster_centers_) / max_subclusters) ** (1 / x.shape[1]), 1.1)
+            bi = Birch(threshold=threshold, n_clusters=None).fit(bi.subcluster_centers_)
+    # Global clustering step only
+    return bi.set_params(n_clusters=n_clusters).partial_fit()
+
+
+def _mean_shift_seeds(x, seeds, bandwidth, max_iter=MEAN_SHIFT_MAX_ITER, tol=MEAN_SHIFT_TOL):
+    """
+    Shift the seeds to the modes of the flat kernel density, all the active seeds at each iteration. A seed that
+    converges is a mode; a seed within a bandwidth of a mode already found stops, as it would be merged with it.
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        modes and number of samples within a bandwidth of each mode
+    """
+    tree = KDTree(x)
+    points = seeds.astype(float)
+    active = np.arange(len(points))
+    modes, intensities = [], []
+    for _ in range(max_iter):
+        if not len(active):
+            break
+        neighbours = tree.query_radius(points[active], r=bandwidth)
+        counts = np.array([len(n) for n in neighbours])
+        # Seeds without neighbours are dropped
+        has = counts > 0
+        active, neighbours, counts = active[has], neighbours[has], counts[has]
+        if not len(active):
+            break
+        starts = np.cumsum(counts) - counts
+        means = np.add.reduceat(x[np.concatenate(neighbours)], starts, axis=0) / counts[:, np.newaxis]
+        converged = np.linalg.norm(means - points[active], axis=1) < tol * bandwidth
+        points[active] = means
+        modes += list(means[converged])
+        intensities += list(counts[converged])
+        active = active[~converged]
+        # Prune the seeds that reached a mode
+        if len(active) and len(modes):
+            dist, _ = KDTree(np.array(modes)).query(points[active], k=1)
+            active = active[dist[:, 0] >= bandwidth]
+    # Seeds stopped by the iterations limit are modes as well
+    if len(active):
+        counts = np.array([len(n) for n in tree.query_radius(points[active], r=bandwidth)])
+        modes += list(points[active])
+        intensities += list(counts)
+    return np.array(modes).reshape(-1, x.shape[1]), np.array(intensities, dtype=np.int64)
+
+
+class _TreeMeanShift:
+    """
+    Mean-shift with KD-tree bandwidth queries and bin seeding. The seeds are shifted in blocks by worker processes,
+    each seed stops at convergence or when it reaches a mode already found; the modes closer than a bandwidth are
+    merged keeping the densest, and each sample is labelled with its nearest mode.
+    """
+    def __init__(self, bandwidth=None, n_jobs=None):
+        self.bandwidth = bandwidth
+        self.n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+        self.cluster_centers_ = None
+        self.labels_ = None
+
+    def fit(self, x):
+        if self.bandwidth is None:
+            self.bandwidth = estimate_bandwidth(x, quantile=0.2, n_samples=min(MEAN_SHIFT_BANDWIDTH_SAMPLES, len(x)),
+                                                random_state=42)
+        seeds = get_bin_seeds(x, self.bandwidth, min_bin_freq=1)
+
+        if self.n_jobs is not None and self.n_jobs > 1 and len(seeds) > self.n_jobs:
+            blocks = np.array_split(seeds, self.n_jobs)
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+                res = list(executor.map(_mean_shift_seeds, [x] * len(blocks), blocks, [self.bandwidth] * len(blocks)))
+            modes = np.concatenate([m for m, _ in res])
+            intensities = np.concatenate([i for _, i in res])
+        else:
+            modes, intensities = _mean_shift_seeds(x, seeds, self.bandwidth)
+
+        # Merge the modes within a bandwidth, the densest first
+        modes = modes[np.argsort(-intensities, kind="stable")]
+        unique = np.ones(len(modes), dtype=bool)
+        tree = KDTree(modes)
+        for i in range(len(modes)):
+            if unique[i]:
+                near = tree.query_radius(modes[i:i + 1], r=self.bandwidth)[0]
+                unique[near[near > i]] = False
+        self.cluster_centers_ = modes[unique]
+        self.labels_ = self.predict(x)
+        return self
+
+    def predict(self, x):
+        tree = KDTree(self.cluster_centers_)
+        return _batched(x, lambda b: tree.query(b, k=1)[1][:, 0])
+
+
+class _GridDBSCAN:
+    """
+    DBSCAN over the occupied cells of a grid: the samples are binned in cells of side cell_size, then the cell
+    centers, weighted by the samples in the cell, are clustered with the neighbour cells in the radius, so that the
+    cost is linear in the samples and the tree queries are over the occupied cells only. Noise label is -1.
+    """
+    def __init__(self, cell_size, min_samples=DBSCAN_MIN_SAMPLES):
+        self.cell_size = cell_size
+        self.min_samples = min_samples
+        self.cells = None
+        self.cell_labels_ = None
+        self.labels_ = None
+
+    def fit(self, x):
+        cells, inverse, counts = np.unique(np.floor(x / self.cell_size).astype(np.int64), axis=0,
+                                           return_inverse=True, return_counts=True)
+        # Radius of the cells that touch the cell, diagonals included
+        db = DBSCAN(eps=self.cell_size * np.sqrt(x.shape[1]) * 1.001, min_samples=self.min_samples,
+                    algorithm="kd_tree")
+        db.fit((cells + 0.5) * self.cell_size, sample_weight=counts)
+        self.cells = cells
+        self.cell_labels_ = db.labels_
+        self.labels_ = db.labels_[inverse.ravel()]
+        return self
+
+
+def _stratified_sample(strata, n_samples, sample_size, random_state=42):
+    # Exactly sample_size samples, about the same fraction of each stratum: a sample for each stratum if there are
+    # not more strata than samples, then floor quotas of the rest and the remainder to the largest fractional parts
+    rng = np.random.default_rng(random_state)
+    if strata is None:
+        return np.sort(rng.choice(n_samples, size=sample_size, replace=False))
+    order = np.lexsort((rng.random(n_samples), strata))
+    counts = np.bincount(strata)
+    starts = np.cumsum(counts) - counts
+    rank = np.arange(n_samples) - np.repeat(starts, counts)
+
+    base = (counts > 0).astype(np.int64)
+    if base.sum() > sample_size:
+        base[:] = 0
+    exact = (counts - base) * (sample_size - base.sum()) / (n_samples - base.sum())
+    quota = base + np.floor(exact).astype(np.int64)
+    # Remainder to the largest fractional parts, ties at random
+    remainder = sample_size - quota.sum()
+    quota[np.lexsort((rng.random(len(counts)), -(exact - np.floor(exact))))[:remainder]] += 1
+    return np.sort(order[rank < np.repeat(quota, counts)])
+
+
+def _batched(x, fn, reduce=np.concatenate, batch_size=ASSIGN_BATCH_SIZE):
+    return reduce([fn(x[lo:lo + batch_size]) for lo in range(0, x.shape[0], batch_size)])
+
+
+def _assign(x, idx, sample_labels, model, assign="auto"):
+    # Labels of all the samples: the sampled ones keep the fitted label, the others are assigned in batches
+    if assign == "auto":
+        assign = "predict" if hasattr(model, "predict") else "knn"
+    if assign == "predict":
+        labels = _batched(x, model.predict)
+    elif assign == "centroid":
+        sample, clusters = x[idx], np.unique(sample_labels)
+        centroids = np.stack([sample[sample_labels == c].mean(axis=0) for c in clusters])
+        labels = _batched(x, lambda b: clusters[((b[:, np.newaxis, :] - centroids) ** 2).sum(axis=2).argmin(axis=1)])
+    else:
+        knn = KNeighborsClassifier(n_neighbors=min(ASSIGN_NEIGHBORS, len(idx))).fit(x[idx], sample_labels)
+        labels = _batched(x, knn.predict)
+    labels[idx] = sample_labels
+    return labels
+
+
+def _knee(n_clusters, wcss):
+    # Kneedle: with both axes normalized to [0, 1], the point of the decreasing WCSS curve farthest from the chord
+    k = np.asarray(n_clusters, dtype=float)
+    y = np.asarray(wcss, dtype=float)
+    if len(k) < 3 or y[0] == y[-1]:
+        return None
+    distance = (y[0] - y) / (y[0] - y[-1]) - (k - k[0]) / (k[-1] - k[0])
+    return int(k[np.argmax(distance)])
+
+
+def _warm_start_centers(x, centers, n_trials=WARM_START_TRIALS, random_state=42):
+    # Previous centers plus a center drawn as a greedy k-means++ step: candidates sampled with probability
+    # proportional to the squared distance from the centers, the one lowering the most the potential is taken
+    dist = np.full(x.shape[0], np.inf)
+    for c in centers:
+        dist = np.minimum(dist, ((x - c) ** 2).sum(axis=1))
+    rng = np.random.default_rng(random_state + len(centers))
+    candidates = rng.choice(x.shape[0], size=n_trials, p=dist / dist.sum() if dist.sum() > 0 else None)
+    potential = [np.minimum(dist, ((x - x[c]) ** 2).sum(axis=1)).sum() for c in candidates]
+    return np.vstack([centers, x[candidates[np.argmin(potential)]]])
+
+
+def _sweep(x, method, n_clusters_list, warm_start=False, fits=None):
+    """
+    Fit a model for each number of clusters, in order. If fits is a dict, the (inertia, labels, model) of each
+    number of clusters are stored in it.
+
+    Yields
+    ------
+    tuple
+        (n_clusters, inertia, bic, elapsed seconds) of each fit, the BIC only for the models that have it
+    """
+    centers = None
+    for n_clusters in n_clusters_list:
+        start = time.time()
+        init = "k-means++"
+        if warm_start and method in KMEANS_METHODS and centers is not None and len(centers) == n_clusters - 1:
+            init = _warm_start_centers(x, centers)
+        inertia, labels, model, _ = _exec(x, method, n_clusters, init=init)
+        if fits is not None:
+            fits[n_clusters] = (inertia, labels, model)
+        centers = getattr(model, "cluster_centers_", None)
+        bic = model.bic(x) if hasattr(model, "bic") else None
+        yield n_clusters, inertia, bic, time.time() - start
+
+
+def _sweep_block(x, method, n_clusters_list, warm_start=False):
+    # Worker: a contiguous block of the sweep
+    return list(_sweep(x, method, n_clusters_list, warm_start))
@@ -0,0 +1 @@
+from .latent_encoder import LatentEncoder, latency_benchmark, pad_sequences
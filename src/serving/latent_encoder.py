@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import numpy as np
+import pandas as pd
+
+from util.log import Log
+
+log = Log(__name__, enable_console=True, enable_file=False)
+
+# Exported encoder files
+SAVED_MODEL_DN = "saved_model"
+TFLITE_FN = "encoder.tflite"
+META_FN = "meta.json"
+SIGNATURE = "serving_default"
+
+
+def _tflite_interpreter():
+    # The TFLite runtime alone is enough to run the exported encoder, the full TensorFlow is the fallback
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    return Interpreter
+
+
+def pad_sequences(sequences, width=None):
+    """
+    Batch of sequences padded at the beginning, as the autoencoder training.
+
+    Parameters
+    ----------
+    sequences : list or ndarray
+        (windows, features) sequences of each trajectory, or an already padded (sequences, time, features) batch
+    width : int, optional
+        number of windows of the batch, default the longest sequence; the longer sequences keep their last windows
+
+    Returns
+    -------
+    (ndarray, ndarray)
+        (sequences, width, features) float32 windows and (sequences, width) valid mask
+    """
+    if isinstance(sequences, np.ndarray) and sequences.ndim == 3:
+        return sequences.astype(np.float32, copy=False), np.ones(sequences.shape[:2], dtype=bool)
+
+    lengths = np.array([len(s) for s in sequences], dtype=np.int64)
+    width = int(lengths.max()) if width is None else width
+    x = np.zeros((len(sequences), width, np.shape(sequences[0])[-1]), dtype=np.float32)
+    mask = np.zeros((len(sequences), width), dtype=bool)
+    for i, s in enumerate(sequences):
+        n = min(len(s), width)
+        if n:
+            x[i, width - n:] = s[len(s) - n:]
+            mask[i, width - n:] = True
+    return x, mask
+
+
+class LatentEncoder:
+    """
+    Lightweight loader of an exported autoencoder encoder, that embeds moving behavior sequences on CPU without the
+    training stack: the TFLite artifact needs only the TFLite runtime, the SavedModel only TensorFlow.
+
+    Parameters
+    ----------
+    export_dir : str
+        directory written by dl.export_encoder
+    backend : str
+        "tflite" or "saved_model"
+    num_threads : int, optional
+        CPU threads of the TFLite interpreter, default the runtime choice
+    """
+    def __init__(self, export_dir, backend="tflite", num_threads=None):
+        self.export_dir = export_dir
+        self.backend = backend if backend in ["tflite", "saved_model"] else "tflite"
+        with open(os.path.join(export_dir, META_FN), "r") as f:
+            self.meta = json.load(f)
+        self.feature_dim = self.meta["feature_dim"]
+        self.latent_dim = self.meta["latent_dim"]
+        if self.backend == "tflite" and not self.meta.get("tflite", True):
+            log.w("LatentEncoder: {} exported without TFLite, SavedModel backend".format(export_dir))
+            self.backend = "saved_model"
+
+        if self.backend == "tflite":
+            interpreter = _tflite_interpreter()(model_path=os.path.join(export_dir, TFLITE_FN),
+                                                num_threads=num_threads)
+            self.runner = interpreter.get_signature_runner(SIGNATURE)
+        else:
+            import tensorflow as tf
+            signature = tf.saved_model.load(os.path.join(export_dir, SAVED_MODEL_DN)).signatures[SIGNATURE]
+            self.runner = lambda x, mask: {k: v.numpy() for k, v in signature(x=tf.constant(x),
+                                                                             mask=tf.constant(mask)).items()}
+
+    def embed(self, sequences, mask=None):
+        """
+        Latent state of each sequence.
+
+        Parameters
+        ----------
+        sequences : list or ndarray
+            (windows, features) sequences, or a (sequences, time, features) batch padded at the beginning
+        mask : ndarray, optional
+            (sequences, time) mask of the valid windows of a padded batch
+
+        Returns
+        -------
+        ndarray
+            (sequences, 2 * latent_dim) final encoder states, state_m followed by state_c
+        """
+        x, valid = pad_sequences(sequences)
+        mask = valid if mask is None else np.asarray(mask, dtype=bool)
+        if x.shape[-1] != self.feature_dim:
+            log.e("LatentEncoder: {} features given, {} expected".format(x.shape[-1], self.feature_dim))
+            return np.empty((0, 2 * self.latent_dim), dtype=np.float32)
+        return self.runner(x=x, mask=mask)["latent"]
+
+
+def latency_benchmark(encoder: LatentEncoder, sequences, batch_sizes=(1, 32, 256), repeat=20):
+    """
+    Latency of the encoder for single and batched requests.
+
+    Parameters
+    ----------
+    encoder : LatentEncoder
+        loaded encoder
+    sequences : list
+        (windows, features) sequences used as requests, cycled to fill the batches
+    batch_sizes : tuple
+        number of sequences of each request
+    repeat : int
+        requests timed for each batch size, after a warm up request
+
+    Returns
+    -------
+    DataFrame
+        for each batch size the mean, median and 95th percentile latency of a request and the mean latency of a
+        sequence, in milliseconds
+    """
+    res = []
+    for batch_sz in batch_sizes:
+        batch = [sequences[i % len(sequences)] for i in range(batch_sz)]
+        x, mask = pad_sequences(batch)
+        encoder.embed(x, mask)
+        elapsed = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            encoder.embed(x, mask)
+            elapsed.append((time.perf_counter() - start) * 1e3)
+        res.append({"backend": encoder.backend, "batch_sz": batch_sz, "mean_ms": np.mean(elapsed),
+                    "p50_ms": np.percentile(elapsed, 50), "p95_ms": np.percentile(elapsed, 95),
+                    "sequence_ms": np.mean(elapsed) / batch_sz})
+    return pd.DataFrame(res)
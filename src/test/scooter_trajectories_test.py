@@ -11,8 +11,9 @@ from util.analysis import DataAnalysis
 from util.log import Log
 from util.util import get_elapsed, DATA_FOLDER
 
-from dl import DeepClustering
+from dl import TrajectoryDeepClustering, ParallelDeepClustering, WindowStore, windows_fingerprint
 from dl import RegressiveAutoEncoder, AddonsAutoEncoder, SimpleAutoEncoder
+from serving import LatentEncoder, latency_benchmark
 
 log = Log(__name__, enable_console=True, enable_file=False)
 
@@ -31,14 +32,26 @@ FORCE_RENTAL_NUM_TO_ANALYZE = 100
 CLUSTERING_METHODS = ["k-means", "mean-shift", "gaussian-mixture", "full-agglomerative", "ward-agglomerative"]
 CLUSTERING_EXAM_METHODS = ["k-means", "mean-shift", "ward-agglomerative"]
 POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING = 30000
+# Methods that cluster only the first POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING positions
+TRUNCATED_CLUSTERING_METHODS = ["full-agglomerative", "ward-agglomerative"]
+# Methods fitted on a sample stratified by rental when the clustering sample size is set
+SAMPLED_CLUSTERING_METHODS = ["mean-shift", "gaussian-mixture", "full-agglomerative", "ward-agglomerative"]
+# Methods that find the number of clusters by themselves
+NO_N_CLUSTERS_METHODS = ["mean-shift", "tree-mean-shift", "grid-dbscan", "dbscan", "hdbscan"]
 
 
 class ScooterTrajectoriesTest:
-    def __init__(self, log_lvl=None, chunk_size=None, max_chunk_num=None, rental_num_to_analyze=None,
-                 timedelta=None, spreaddelta=None, edgedelta=None, group_on_timedelta=True,
-                 n_clusters=None, with_pca=False, with_standardization=False, with_normalization=False,
-                 only_north=False, epoch=None, latent_dim=None, dl_config=None,
-                 hidden_dim=None, exam=False):
+    def __init__(self, log_lvl=None, chunk_size=None, max_chunk_num=None, rental_num_to_analyze=None, timedelta=None,
+                 spreaddelta=None, edgedelta=None, group_on_timedelta=True, n_clusters=None, kmeans_method="k-means",
+                 ward_method="ward-agglomerative", mean_shift_method="mean-shift", auto_n_clusters=False,
+                 clustering_n_jobs=None, clustering_warm_start=False, clustering_preprocessing_cache=False,
+                 clustering_sample_size=None, density_method=None, dbscan_eps=None, grid_cell_size=None,
+                 silhouette_sample_size=20000, with_pca=False, with_standardization=False, with_normalization=False,
+                 only_north=False, moving_behavior_n_jobs=None, moving_behavior_stream=False,
+                 moving_behavior_time_window=False, sliding_window_width=None, sliding_window_offset=None,
+                 moving_behavior_features_cols=None, dl_global=False, dl_eager=False, dl_n_jobs=None,
+                 dl_max_windows=None, dl_tuned_pipeline=False, dl_batch_size=None, dl_multi_decoder=False,
+                 dl_export=False, epoch=None, latent_dim=None, dl_config=None, hidden_dim=None, exam=False):
         self.st = ScooterTrajectoriesDS(log_lvl=log_lvl)
         # Generation settings
         self.chunk_size = chunk_size
@@ -51,11 +64,43 @@ class ScooterTrajectoriesTest:
         self.edgedelta = edgedelta
         # Clustering settings
         self.n_clusters = n_clusters
+        self.kmeans_method = kmeans_method
+        self.ward_method = ward_method
+        self.mean_shift_method = mean_shift_method
+        self.auto_n_clusters = auto_n_clusters
+        self.clustering_n_jobs = clustering_n_jobs
+        self.clustering_warm_start = clustering_warm_start
+        self.clustering_sample_size = clustering_sample_size
+        self.density_method = density_method
+        self.dbscan_eps = dbscan_eps
+        self.grid_cell_size = grid_cell_size
+        # Silhouette samples of the evaluation, None for the exact score
+        self.silhouette_sample_size = silhouette_sample_size
+        # Preprocessed clustering data persisted across runs
+        self.preprocessing_cache_dir = os.path.join(DATA_FOLDER, STC.GENERATED_DN,
+                                                    STC.CLUSTERING_PREPROCESSING_CACHE_DN) \
+            if clustering_preprocessing_cache else None
         self.with_pca = with_pca
         self.with_standardization = with_standardization
         self.with_normalization = with_normalization
         self.only_north = only_north
+        # Moving behavior feature extraction settings
+        self.moving_behavior_n_jobs = moving_behavior_n_jobs
+        self.moving_behavior_stream = moving_behavior_stream
+        self.moving_behavior_time_window = moving_behavior_time_window
+        self.sliding_window_width = sliding_window_width
+        self.sliding_window_offset = sliding_window_offset
+        self.moving_behavior_features_cols = moving_behavior_features_cols if moving_behavior_features_cols \
+            else STC.MOVING_BEHAVIOR_FEATURES_COLS
         # Deep Learning Clustering
+        self.dl_global = dl_global
+        self.dl_eager = dl_eager
+        self.dl_n_jobs = dl_n_jobs
+        self.dl_max_windows = dl_max_windows
+        self.dl_tuned_pipeline = dl_tuned_pipeline
+        self.dl_batch_size = dl_batch_size
+        self.dl_multi_decoder = dl_multi_decoder
+        self.dl_export = dl_export
         self.epoch = epoch
         self.latent_dim = latent_dim
         self.dl_config = dl_config
@@ -182,14 +227,6 @@ class ScooterTrajectoriesTest:
                                        prefix=prefix_with_cardinal)
         return self
 
-    def __train_moving_attributes(self, moving_attributes):
-        log.i("Train Moving Attributes - Trajectory {}".format(moving_attributes.iloc[0][self.groupby].to_dict()))
-        dc = DeepClustering(moving_attributes[STC.MOVING_BEHAVIOR_FEATURES_COLS], self.latent_dim,
-                            hidden_dim=self.hidden_dim, model=self.dl_config, epoch=self.epoch, batch_sz=1)
-        dc.train()
-        ret = pd.DataFrame([dc.get_latent_state()])
-        return ret
-
     def load_from_original(self):
         log.d("Test {} start load from original data".format(DATASET_NAME))
         if self.is_data_processed():
@@ -253,18 +290,41 @@ class ScooterTrajectoriesTest:
         partitions = self.__partition(dataset_for_clustering, only_north=self.only_north)
 
         # Perform clustering tests
-        kmeans = Clustering(dataset_for_clustering, STC.CLUSTERING_COLS, dataset_name=DATASET_NAME)
-        kmeans.test("k-means", range_clusters=range(1, 20), standardize=self.with_standardization,
-                    normalize=self.with_normalization,  pca=self.with_pca, components=STC.CLUSTERING_COMPONENTS)
+        kmeans = Clustering(dataset_for_clustering, STC.CLUSTERING_COLS, dataset_name=DATASET_NAME,
+                            preprocessing_cache_dir=self.preprocessing_cache_dir)
+        kmeans.test(self.kmeans_method, range_clusters=range(1, 20), standardize=self.with_standardization,
+                    normalize=self.with_normalization,  pca=self.with_pca, components=STC.CLUSTERING_COMPONENTS,
+                    n_jobs=self.clustering_n_jobs, warm_start=self.clustering_warm_start)
         kmeans.show_wcss(save_file=SAVE_FILE, prefix=prefix + "all")
         for key in partitions:
-            kmeans = Clustering(partitions[key], STC.CLUSTERING_COLS, dataset_name=DATASET_NAME)
-            kmeans.test("k-means", range_clusters=range(1, 30), standardize=self.with_standardization,
-                        normalize=self.with_normalization, pca=self.with_pca, components=STC.CLUSTERING_COMPONENTS)
+            kmeans = Clustering(partitions[key], STC.CLUSTERING_COLS, dataset_name=DATASET_NAME,
+                                preprocessing_cache_dir=self.preprocessing_cache_dir)
+            kmeans.test(self.kmeans_method, range_clusters=range(1, 30), standardize=self.with_standardization,
+                        normalize=self.with_normalization, pca=self.with_pca, components=STC.CLUSTERING_COMPONENTS,
+                        n_jobs=self.clustering_n_jobs, warm_start=self.clustering_warm_start)
             kmeans.show_wcss(save_file=SAVE_FILE, prefix=prefix + key)
 
+    def __is_truncated(self, method):
+        # The first positions only, unless the method is fitted on a sample and assigns all the positions
+        return method in TRUNCATED_CLUSTERING_METHODS and POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING is not None and \
+            self.clustering_sample_size is None
+
+    def __cluster(self, c, method, pca=False, components=None):
+        n_clusters = self.n_clusters
+        if n_clusters is None and self.auto_n_clusters and method not in NO_N_CLUSTERS_METHODS:
+            # Automatic number of clusters: BIC for the gaussian mixture, WCSS knee of the k-means for the others
+            selection_method = method if method == "gaussian-mixture" else self.kmeans_method
+            n_clusters = c.select_n_clusters(selection_method, range_clusters=range(1, 30),
+                                             standardize=self.with_standardization, normalize=self.with_normalization,
+                                             pca=pca, components=components,
+                                             warm_start=self.clustering_warm_start).n_clusters
+        sample_size = self.clustering_sample_size if method in SAMPLED_CLUSTERING_METHODS else None
+        return c.exec(method=method, n_clusters=n_clusters, standardize=self.with_standardization,
+                      normalize=self.with_normalization, pca=pca, components=components, sample_size=sample_size,
+                      eps=self.dbscan_eps, cell_size=self.grid_cell_size, n_jobs=self.clustering_n_jobs)
+
     def clustering(self):
-        if self.n_clusters is None:
+        if self.n_clusters is None and not self.auto_n_clusters:
             self.test_clustering()
             return self
 
@@ -277,6 +337,14 @@ class ScooterTrajectoriesTest:
             clustering_methods = CLUSTERING_EXAM_METHODS
         else:
             clustering_methods = CLUSTERING_METHODS
+        # k-means variant: full batch, mini-batch or streaming; ward variant: truncated or BIRCH pre-aggregated;
+        # mean-shift variant: sklearn or KD-tree with parallel seeds
+        clustering_methods = [self.kmeans_method if m == "k-means" else m for m in clustering_methods]
+        clustering_methods = [self.ward_method if m == "ward-agglomerative" else m for m in clustering_methods]
+        clustering_methods = [self.mean_shift_method if m == "mean-shift" else m for m in clustering_methods]
+        # Density-based method in addition
+        if self.density_method:
+            clustering_methods = clustering_methods + [self.density_method]
 
         components = STC.CLUSTERING_COMPONENTS  # STC.CLUSTERING_COMPONENTS or None or a number
         dataset_for_clustering = self.__prepare()
@@ -290,15 +358,16 @@ class ScooterTrajectoriesTest:
             self.partitions_clusters[method] = dict()
             for key in partitions:
                 log.d("Test {} clustering of {} data with {}".format(DATASET_NAME, key, method))
-                if method.endswith("agglomerative") and POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING is not None:
+                if self.__is_truncated(method):
                     c = Clustering(partitions[key].iloc[:POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING],
-                                   STC.CLUSTERING_COLS, dataset_name=DATASET_NAME)
+                                   STC.CLUSTERING_COLS, dataset_name=DATASET_NAME,
+                                   preprocessing_cache_dir=self.preprocessing_cache_dir)
                 else:
-                    c = Clustering(partitions[key], STC.CLUSTERING_COLS, dataset_name=DATASET_NAME)
-                c.exec(method=method, n_clusters=self.n_clusters,
-                       standardize=self.with_standardization, normalize=self.with_normalization,
-                       pca=self.with_pca, components=components)
-                self.partitions_clusters[method][key] = c
+                    c = Clustering(partitions[key], STC.CLUSTERING_COLS, dataset_name=DATASET_NAME,
+                                   preprocessing_cache_dir=self.preprocessing_cache_dir,
+                                   strata=STC.POS_GEN_RENTAL_ID_CN)
+                self.partitions_clusters[method][key] = self.__cluster(c, method, pca=self.with_pca,
+                                                                       components=components)
 
         self.all_clusters = dict()
         if self.exam:
@@ -307,48 +376,101 @@ class ScooterTrajectoriesTest:
         # Perform clustering in relation to the entire data
         for method in clustering_methods:
             log.d("Test {} clustering of entire data with {}".format(DATASET_NAME, method))
-            if method.endswith("agglomerative") and POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING is not None:
+            if self.__is_truncated(method):
                 c = Clustering(dataset_for_clustering.iloc[:POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING],
-                               STC.CLUSTERING_COLS, dataset_name=DATASET_NAME)
+                               STC.CLUSTERING_COLS, dataset_name=DATASET_NAME,
+                               preprocessing_cache_dir=self.preprocessing_cache_dir)
             else:
-                c = Clustering(dataset_for_clustering, STC.CLUSTERING_COLS, dataset_name=DATASET_NAME)
-            c.exec(method=method, n_clusters=self.n_clusters,
-                   standardize=self.with_standardization, normalize=self.with_normalization,
-                   pca=self.with_pca, components=components)
-            self.all_clusters[method] = c
+                c = Clustering(dataset_for_clustering, STC.CLUSTERING_COLS, dataset_name=DATASET_NAME,
+                               preprocessing_cache_dir=self.preprocessing_cache_dir,
+                               strata=STC.POS_GEN_RENTAL_ID_CN)
+            self.all_clusters[method] = self.__cluster(c, method, pca=self.with_pca, components=components)
 
         self.clustering_done = True
 
     def moving_behavior_feature_extraction(self):
-        self.st.moving_behavior_feature_extraction(groupby=self.groupby).to_csv()
+        if self.moving_behavior_stream:
+            # Features appended to the generated file without keeping them in memory
+            self.st.moving_behavior_feature_extraction_stream(groupby=self.groupby,
+                                                              sliding_window_width=self.sliding_window_width,
+                                                              sliding_window_offset=self.sliding_window_offset,
+                                                              n_jobs=self.moving_behavior_n_jobs,
+                                                              time_window=self.moving_behavior_time_window,
+                                                              features=self.moving_behavior_features_cols)
+            # The features of the file are the input of the deep learning clustering of the same run
+            self.st.moving_behavior_features = pd.read_csv(
+                os.path.join(DATA_FOLDER, STC.GENERATED_DN, STC.CSV_MOVING_BEHAVIOR_FEATURE), memory_map=True)
+            return
+        self.st.moving_behavior_feature_extraction(groupby=self.groupby,
+                                                   sliding_window_width=self.sliding_window_width,
+                                                   sliding_window_offset=self.sliding_window_offset,
+                                                   n_jobs=self.moving_behavior_n_jobs,
+                                                   time_window=self.moving_behavior_time_window,
+                                                   features=self.moving_behavior_features_cols).to_csv()
 
     def dl_clustering(self):
+        if self.n_clusters is None and not self.auto_n_clusters:
+            log.e("Test {} dl clustering: set the number of clusters or the automatic selection".format(DATASET_NAME))
+            return self
+
         dataset_for_clustering = self.__prepare(is_dl=True)
 
-        self.st.moving_behavior_features = self.st.moving_behavior_features.iloc[0:1000]
-        mbf_group = self.st.moving_behavior_features.groupby(by=self.groupby)
+        if not self.dl_global and self.dl_max_windows is not None:
+            # A model for each trajectory: only the first windows, rounded up to the end of a trajectory so that the
+            # content hash of the last trajectory does not depend on the cut
+            mbf = self.st.moving_behavior_features
+            traj_ids = mbf.groupby(by=self.groupby, sort=False).ngroup().to_numpy()
+            if len(traj_ids) > self.dl_max_windows:
+                self.st.moving_behavior_features = mbf.loc[traj_ids <= traj_ids[self.dl_max_windows - 1]]
+
+        # Window sequences written once and memory mapped by the later runs
+        groupby = self.groupby if type(self.groupby) == list else [self.groupby]
+        store = WindowStore(os.path.join(DATA_FOLDER, STC.GENERATED_DN, STC.MOVING_BEHAVIOR_WINDOW_STORE_DN))
+        # The fingerprint of the windows detects re-extracted features with the same number of windows
+        fingerprint = windows_fingerprint(self.st.moving_behavior_features, groupby, self.moving_behavior_features_cols)
+        if store.exists(groupby, self.moving_behavior_features_cols, len(self.st.moving_behavior_features.index),
+                        fingerprint=fingerprint):
+            store.load()
+        else:
+            store.write(self.st.moving_behavior_features, groupby, self.moving_behavior_features_cols,
+                        fingerprint=fingerprint)
 
-        for self.dl_config in ["simple", "autoregressive", "addons"]:
-            autoencoder_gen_fp = os.path.join(DATA_FOLDER, self.dl_config + "_autoencoder_feature.csv")
+        # The decoders trained jointly on a shared encoder have the same latent state: a single set of features
+        for self.dl_config in ["multi"] if self.dl_multi_decoder else ["simple", "autoregressive", "addons"]:
+            autoencoder_gen_fp = os.path.join(DATA_FOLDER, self.dl_config + ("_global" if self.dl_global else "") +
+                                              "_autoencoder_feature.csv")
             autoencoder_features_cols = \
                 ["state_m" + str(i) for i in range(self.latent_dim)] + \
                 ["state_c" + str(i) for i in range(self.latent_dim)]
-            if not os.path.exists(autoencoder_gen_fp):
-                autoencoder_features = mbf_group.apply(self.__train_moving_attributes)
-                autoencoder_features = autoencoder_features.reset_index(drop=False)
-                autoencoder_features = autoencoder_features.drop(
-                    autoencoder_features.columns[len(self.groupby) if type(self.groupby) == list else 1], axis=1)
-                autoencoder_features = autoencoder_features.rename(
-                    columns=dict(zip(autoencoder_features.columns, self.groupby + autoencoder_features_cols)))
+            if not os.path.exists(autoencoder_gen_fp) and self.dl_global:
+                # A single model shared by all the trajectories
+                dc = TrajectoryDeepClustering(store, self.groupby, self.moving_behavior_features_cols, self.latent_dim,
+                                              hidden_dim=self.hidden_dim, model=self.dl_config, epoch=self.epoch,
+                                              eager=self.dl_eager)
+                dc.train()
+                autoencoder_features = dc.get_latent_state()
+                autoencoder_features.to_csv(autoencoder_gen_fp, index=False)
+                if self.dl_export:
+                    self.__dl_export(dc, store)
+            elif not self.dl_global:
+                # A model for each trajectory, trained by a pool of workers: the latent cache serves the trajectories
+                # already trained with the same windows and hyperparameters, the new or changed ones are trained
+                cache_fp = os.path.join(DATA_FOLDER, "{}_{}_autoencoder_latent_cache.csv".format(
+                    self.dl_config, self.latent_dim))
+                dc = ParallelDeepClustering(store, self.groupby, self.moving_behavior_features_cols, self.latent_dim,
+                                            hidden_dim=self.hidden_dim, model=self.dl_config, epoch=self.epoch,
+                                            batch_sz=self.dl_batch_size, n_jobs=self.dl_n_jobs, cache_fp=cache_fp,
+                                            eager=self.dl_eager, tuned_pipeline=self.dl_tuned_pipeline)
+                autoencoder_features = dc.train().get_latent_state()
                 # Save data in csv files
                 autoencoder_features.to_csv(autoencoder_gen_fp, index=False)
             else:
                 autoencoder_features = pd.read_csv(autoencoder_gen_fp, memory_map=True)
 
             # k-means clustering
-            c = Clustering(autoencoder_features, autoencoder_features_cols, dataset_name=DATASET_NAME)
-            c.exec(method="k-means", n_clusters=self.n_clusters,
-                   standardize=self.with_standardization, normalize=self.with_normalization)
+            c = Clustering(autoencoder_features, autoencoder_features_cols, dataset_name=DATASET_NAME,
+                           preprocessing_cache_dir=self.preprocessing_cache_dir)
+            self.__cluster(c, self.kmeans_method)
             autoencoder_features[STC.CLUSTER_ID_CN] = c.labels
 
             # Prepare data
@@ -368,12 +490,22 @@ class ScooterTrajectoriesTest:
             partitions = self.__partition(dataset_prepared, only_north=True if self.exam else self.only_north)
 
             # Analysis
-            prefix = "{}_{}_{}_".format("dl_clustering", "k-means", self.dl_config)
+            prefix = "{}_{}_{}_".format("dl_clustering", self.kmeans_method, self.dl_config)
             for key in partitions:
                 self.__line_joint_analysis(self.__filter(partitions[key]), prefix=prefix + key,
                                            line_list=[STC.CLUSTER_ANALYSIS_TUPLE],
                                            line_3d_list=[STC.CLUSTER_ANALYSIS_TUPLE])
 
+    def __dl_export(self, dc, store):
+        # Encoder for serving and its CPU latency, single and batched requests over the stored trajectories
+        export_dir = os.path.join(DATA_FOLDER, STC.GENERATED_DN, STC.AUTOENCODER_EXPORT_DN,
+                                  "{}_{}".format(self.dl_config, self.latent_dim))
+        dc.export(export_dir)
+        sequences = [store.sequence(i) for i in range(min(len(store.keys.index), 256))]
+        for backend in ["tflite", "saved_model"]:
+            benchmark = latency_benchmark(LatentEncoder(export_dir, backend=backend), sequences)
+            log.i("Encoder {} latency:\n{}".format(backend, benchmark.to_string(index=False)))
+
     def generated_data_analysis(self):
         log.d("Test {} generated data analysis".format(DATASET_NAME))
         if not self.is_data_processed():
@@ -430,6 +562,29 @@ class ScooterTrajectoriesTest:
         self.__cardinal_analysis(pos_unique_timedelta, prefix=p,
                                  line_list=[STC.POS_GEN_OVER_TIMEDELTA_ANALYSIS_TUPLE])
 
+    def clustering_evaluation(self):
+        log.d("Test {} clustering evaluation".format(DATASET_NAME))
+        if not self.is_clustering_processed():
+            log.e("Test {} clustering evaluation: you have to process clustering earlier".format(DATASET_NAME))
+            return self
+
+        # Scores of each method on each partition and on the entire data, in a single table
+        clusters = [(method, key, self.partitions_clusters[method][key]) for method in self.partitions_clusters
+                    for key in self.partitions_clusters[method]]
+        clusters += [(method, "all", self.all_clusters[method]) for method in self.all_clusters]
+        res = []
+        for method, key, c in clusters:
+            labels = pd.Series(c.labels)
+            res.append({"method": method, "partition": key, "samples": len(labels.index),
+                        "n_clusters": labels[labels != -1].nunique(),
+                        **c.evaluate(sample_size=self.silhouette_sample_size)})
+        evaluation = pd.DataFrame(res)
+        log.i("Clustering evaluation:\n{}".format(evaluation.to_string(index=False)))
+        if SAVE_FILE:
+            evaluation.to_csv(os.path.join(DATA_FOLDER, STC.GENERATED_DN, STC.CSV_CLUSTERING_EVALUATION_FN),
+                              index=False)
+        return self
+
     def clusterized_data_analysis(self):
         log.d("Test {} analysis of clusterized data".format(DATASET_NAME))
         if not self.is_clustering_processed():
@@ -442,12 +597,13 @@ class ScooterTrajectoriesTest:
             # Clustering analysis for each partition
             for key in partitions:
                 log.d("Test {} analysis clusterized of {} data with {}".format(DATASET_NAME, key, method))
-                self.partitions_clusters[method][key].stats()
-                if method.endswith("agglomerative") and POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING is not None:
+                self.partitions_clusters[method][key].stats(sample_size=self.silhouette_sample_size)
+                if self.__is_truncated(method):
                     p = partitions[key].iloc[:POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING].copy()
-                    self.partitions_clusters[method][key].show_dendrogram(prefix=prefix + key, save_file=SAVE_FILE)
                 else:
                     p = partitions[key].copy()
+                if method.endswith("agglomerative"):
+                    self.partitions_clusters[method][key].show_dendrogram(prefix=prefix + key, save_file=SAVE_FILE)
                 p[STC.CLUSTER_ID_CN] = self.partitions_clusters[method][key].labels
                 self.__line_joint_analysis(self.__filter(p), prefix=prefix + key,
                                            line_list=[STC.CLUSTER_ANALYSIS_TUPLE],
@@ -456,13 +612,14 @@ class ScooterTrajectoriesTest:
         for method in self.all_clusters:
             log.d("Test {} analysis clusterized of entire data with {}".format(DATASET_NAME, method))
             prefix = "{}_{}_".format(CLUSTER_IMG_FN_PREFIX, method)
-            self.all_clusters[method].stats()
+            self.all_clusters[method].stats(sample_size=self.silhouette_sample_size)
             # Clustering analysis for the entire dataset
-            if method.endswith("agglomerative") and POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING is not None:
+            if self.__is_truncated(method):
                 d = dataset_for_clustering.iloc[:POS_NUM_FOR_AGGLOMERATIVE_CLUSTERING].copy()
-                self.all_clusters[method].show_dendrogram(prefix=prefix + "all", save_file=SAVE_FILE)
             else:
                 d = dataset_for_clustering.copy()
+            if method.endswith("agglomerative"):
+                self.all_clusters[method].show_dendrogram(prefix=prefix + "all", save_file=SAVE_FILE)
             d[STC.CLUSTER_ID_CN] = self.all_clusters[method].labels
             self.__line_joint_analysis(self.__filter(d), line_list=[STC.CLUSTER_ANALYSIS_TUPLE], prefix=prefix + "all")
             self.__cardinal_analysis(d, line_list=[STC.CLUSTER_ANALYSIS_TUPLE], prefix=prefix + "all")
@@ -496,7 +653,7 @@ class ScooterTrajectoriesTest:
 
     def cluster_maps(self):
         key = "N-E"
-        method = "k-means"
+        method = self.kmeans_method
         log.d("Test {} generate maps for clustering".format(DATASET_NAME))
         if not self.is_clustering_processed():
             log.e("Test {} maps for clustering: you have to process clustering earlier".format(DATASET_NAME))
@@ -514,7 +671,7 @@ class ScooterTrajectoriesTest:
 
     def cluster_maps_3d(self):
         key = "N-E"
-        method = "k-means"
+        method = self.kmeans_method
         log.d("Test {} generate maps 3D for clustering".format(DATASET_NAME))
         if not self.is_clustering_processed():
             log.e("Test {} maps 3D for clustering: you have to process clustering earlier".format(DATASET_NAME))